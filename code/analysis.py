@@ -0,0 +1,268 @@
+"""BirdTrails/analysis.py is the importable version of the by_trail.py and by_bird.py analyses
+
+This script holds the analysis steps of the two interactive tools as functions, so they can be
+run for many trails and species from one Python process:
+
+    analyse_trail('Milford Track')  -> the bird occupancy along a trail and its top species
+    analyse_trail_near('Milford Track', radii_km=(2, 5))
+                                    -> the bird occupancy within some distances of a trail
+    analyse_species('kea')          -> the trails through the highest occupancy grids for a bird
+
+The datasets (trails, occupancy grid, species attributes and the trail/grid incidence index)
+are loaded by load_data() the first time they are needed and then kept, so the load cost is
+paid once per process rather than once per query. Maps are not drawn here, but the tables of a
+trail whose map was drawn before can be read back from the result cache (see cached_files).
+
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+import datacache
+import resultcache
+from profiling import profiled
+from incidence import load_incidence, cells_for_trails
+from occupancy import ATTRIBUTES_PATH, species_codes
+from gridstream import unpack
+from trailsearch import load_name_index, find_trail
+from routes import load_routes, segment_routes, distinct_routes
+from landuse import load_overlay, landuse_profile
+from pipeline import update_caches, map_version
+from proximity import cell_index, cells_within, near_occupancy
+from species_index import load_species_index, best_cells, top_trails as species_top_trails, trails_with_all
+
+
+# datasets loaded by load_data, kept for the life of the process
+_data = None
+
+
+# load the datasets used by the analyses, once per process
+@profiled
+def load_data():
+    global _data
+    if _data is None:
+        trails = datacache.load('trails')
+        grid = datacache.load('grid')
+        bird_details = pd.read_csv(ATTRIBUTES_PATH) # species attributes for table linking
+        species = species_codes(grid, bird_details) # species codes with occupancy data
+        features, _ = update_caches(trails, grid, species) # recompute only what changed in the data (see pipeline.py)
+        _data = {
+            'trails': trails,
+            'grid': grid,
+            'bird_details': bird_details,
+            'bird_names': dict(zip(bird_details['Code'], bird_details['Common_name'])), # species code -> common name
+            'species': species,
+            'features': features, # hashes of every trail, grid cell and species
+            'incidence': load_incidence(trails, grid),
+        }
+        _data['species_index'] = load_species_index(_data['incidence'], grid, _data['species']) # cells and trails ranked per species
+        _data['trail_names'] = load_name_index(trails) # trail name search index
+        _data['routes'] = load_routes(trails) # trail segments grouped into whole routes
+        _data['route_of'] = segment_routes(_data['routes']) # the route id of each trail segment
+    return _data
+
+
+# a dataset only some queries use, loaded into data the first time it is asked for rather than
+# by load_data. load is given the datasets of load_data (so the whole grid, even when data['grid']
+# is only part of it), and the result is kept with them so copies (see render.load_base) share it
+def lazy(data, key, load):
+    if key not in data:
+        full = load_data()
+        if key not in full:
+            full[key] = load(full)
+        data[key] = full[key]
+    return data[key]
+
+
+# bird occupancy along a trail, as in by_trail.py. The name is found in any case, with or without
+# macrons and punctuation (see trailsearch.py), and result['name'] is the name as in the data.
+# data['grid'] can also be only the cells near the trail, indexed by cell id and with packed
+# species columns (see gridstream.py). Segments of the name far apart are separate routes (see
+# routes.py): result['route_km'] has the length of each, and result['length_km'] is that of the
+# first. With cached=True the birdstats and toplist are read from the result cache when the trail
+# was drawn before for the same data (see cached_files). Raises KeyError if there is no trail with this name
+@profiled
+def analyse_trail(name, data=None, top_species=15, cached=False):
+    data = data or load_data()
+    trails, grid = data['trails'], data['grid']
+
+    # every segment of the trail with this name, from the name index
+    name, trail_ids = find_trail(data['trail_names'], name)
+    selected_trail = trails.iloc[trail_ids]
+
+    # grids the trail passes through, from the incidence index
+    intersect_id = cells_for_trails(data['incidence'], selected_trail.index).tolist()
+
+    files = cached_files('trail', name, data) if cached else None
+    if files is not None:
+        birdstats, toplist = cached_trail_tables(files, intersect_id, top_species)
+    else:
+        # length of the trail inside each grid (m), used to weight the average
+        grid_lengths = np.asarray(data['incidence'][selected_trail.index.to_numpy()][:, intersect_id].sum(axis=0)).ravel()
+        if grid_lengths.sum() == 0:
+            grid_lengths = np.ones(len(intersect_id)) # the trail only touches grid edges, so weight the grids equally
+
+        # occupancy of every species in the intersected grids, as a percent, with the length weighted average
+        # (the block is unpacked at once, as DataFrame.apply fails on the empty block of a trail outside the grid)
+        block = grid.loc[intersect_id, data['species']]
+        birdstats = pd.DataFrame(unpack(block.to_numpy()), index=block.index, columns=block.columns).rename(columns=data['bird_names']) * 100
+        if intersect_id:
+            birdstats.loc['Avg'] = (birdstats.mul(grid_lengths, axis=0).sum() / grid_lengths.sum()).round(2)
+        else:
+            birdstats.loc['Avg'] = np.nan # the trail is outside the occupancy grid
+
+        # the species with the highest average occupancy
+        toplist = birdstats.loc['Avg'].sort_values(ascending=False).head(top_species)
+
+    # the routes of the segments, so unrelated trails sharing the name are not added together
+    route_ids = distinct_routes(data['route_of'], trail_ids).tolist()
+    route_km = data['routes']['SHAPE_Leng'].loc[route_ids].to_numpy() / 1000
+
+    # trail x land use x grid lengths (see landuse.py), only loaded once a trail is analysed
+    overlay = lazy(data, 'landuse', lambda full: load_overlay(full['trails'], full['grid']))
+
+    return {
+        'name': name,
+        'trail': selected_trail,
+        'grids': intersect_id,
+        'route_ids': route_ids,
+        'route_km': route_km,
+        'length_km': route_km[0], # the route of the first segment
+        'birdstats': birdstats,
+        'toplist': toplist,
+        'landuse': landuse_profile(overlay, trail_ids), # percent of the length in each land use (see landuse.py)
+    }
+
+
+# bird occupancy within some distances (km) of a trail rather than only in the grids it crosses,
+# with the cells weighted by decay, one of proximity.DECAYS (see proximity.py). result['nearby'] is
+# a species x distance table in percent, sorted by the occupancy at the last distance
+@profiled
+def analyse_trail_near(name, data=None, radii_km=(2,), decay='none', top_species=15):
+    data = data or load_data()
+    name, trail_ids = find_trail(data['trail_names'], name)
+    trail = shapely.union_all(np.asarray(data['trails'].geometry)[trail_ids]) # every segment of the trail
+
+    # R-tree of the grid cell centroids, for distance queries, only built once a distance is asked for
+    index = lazy(data, 'cell_index', lambda full: cell_index(full['grid']))
+    occupancy = near_occupancy(index, data['grid'], data['species'], [trail], radii_km, decay)[0] * 100
+    nearby = pd.DataFrame(occupancy.T, index=data['species'], columns=[f'{radius:g} km' for radius in radii_km]).round(2)
+    nearby = nearby.rename(index=data['bird_names']).sort_values(nearby.columns[-1], ascending=False)
+    return {
+        'name': name,
+        'radii_km': list(radii_km),
+        'grids': {radius: cells_within(index, [trail], radius)[0].tolist() for radius in radii_km}, # the cells within each distance
+        'nearby': nearby,
+        'toplist': nearby.iloc[:, -1].head(top_species),
+    }
+
+
+# the routes of ranked trail segments, each listed once and limited to top_trails, and the
+# result entries for them: the route ids in rank order, the ids of all their segments, and the
+# routes sorted by name, with their length in km, as the top list (see routes.py)
+def route_results(data, trail_ids, top_trails):
+    route_ids = distinct_routes(data['route_of'], trail_ids)[:top_trails].tolist()
+    routes = data['routes'].loc[route_ids]
+    toplist = routes.sort_values(by='name', axis=0, ascending=True)
+    toplist['SHAPE_Leng'] = (toplist['SHAPE_Leng'] / 1000).round(1)
+    return {
+        'route_ids': route_ids,
+        'trail_ids': [int(trail_id) for segments in routes['segments'] for trail_id in segments],
+        'toplist': toplist,
+    }
+
+
+# trails through the highest occupancy grids for a species, as in by_bird.py. The top_grids
+# best grids are checked, limited to grids with an occupancy (0-1) of at least threshold if given.
+# trails are listed as whole routes, each once, best first in result['route_ids'].
+# raises KeyError if there is no occupancy data for this species code
+@profiled
+def analyse_species(code, data=None, top_grids=50, top_trails=15, threshold=None):
+    data = data or load_data()
+    index = data['species_index'] # see species_index.py
+
+    # the highest occupancy grids, highest first, and the trail segments in them ranked by their best grid
+    grid_sorted = best_cells(index, code, top_grids, threshold)
+    intersect_id = species_top_trails(index, code, None, top_grids, threshold)
+
+    return {
+        'code': code,
+        'name': data['bird_names'].get(code, code),
+        'grids': grid_sorted.tolist(),
+        **route_results(data, intersect_id, top_trails),
+    }
+
+
+# trails through the highest occupancy grids of every species in codes, e.g. ['kea', 'kaka']
+# for trails with both kea and kaka. Trails high on every species' list come first.
+# raises KeyError if there is no occupancy data for one of the species codes
+@profiled
+def analyse_species_all(codes, data=None, top_grids=50, top_trails=15, threshold=None):
+    data = data or load_data()
+    intersect_id = trails_with_all(data['species_index'], codes, None, top_grids, threshold)
+
+    return {
+        'codes': list(codes),
+        'names': [data['bird_names'].get(code, code) for code in codes],
+        **route_results(data, intersect_id, top_trails),
+    }
+
+
+# the .csv tables of a trail or species result, as {file name: contents}
+def result_tables(kind, result):
+    if kind == 'trail':
+        return {
+            f"{result['name']} occupancy data.csv": result['birdstats'].to_csv(index=False).encode('utf-8'),
+            f"{result['name']} top species.csv": result['toplist'].rename('Occupancy (%)').to_csv(index_label='Species').encode('utf-8'),
+        }
+    toplist = result['toplist'][['name', 'SHAPE_Leng', 'difficulty', 'completion', 'walkingAnd']]
+    toplist = toplist.rename(columns={'SHAPE_Leng': 'length_km', 'walkingAnd': 'website'})
+    return {f"{result['name']} top trails.csv": toplist.to_csv(index=False).encode('utf-8')}
+
+
+# the result cache key of a trail or species query (see resultcache.py), with the version of the
+# data its map and tables are drawn from (see pipeline.map_version). Trail names are resolved to
+# the name as in the data first, so every spelling of a trail shares one entry. Only species
+# results depend on top_grids
+def cache_key(kind, key, data=None, top_grids=50):
+    data = data or load_data()
+    if kind == 'trail':
+        try:
+            key, _ = find_trail(data['trail_names'], key)
+        except KeyError:
+            pass # not in the data, so never stored
+    version = map_version(data, kind, key, top_grids)
+    return resultcache.result_key(kind, key, {'top_grids': top_grids} if kind == 'species' else None, version)
+
+
+# the stored map and .csv tables of a query (see render.render_job), as {file name: path}, or
+# None if it has not been drawn for the current data
+def cached_files(kind, key, data=None, top_grids=50):
+    return resultcache.get(cache_key(kind, key, data, top_grids))
+
+
+# the birdstats and toplist of a trail from its cached .csv tables (see result_tables). The
+# occupancy table is saved without its index, which is the grids followed by the 'Avg' row
+def cached_trail_tables(files, grids, top_species=15):
+    tables = {suffix: next(path for name, path in files.items() if name.endswith(suffix)) for suffix in (' occupancy data.csv', ' top species.csv')}
+    birdstats = pd.read_csv(tables[' occupancy data.csv'])
+    birdstats.index = list(grids) + ['Avg']
+    toplist = pd.read_csv(tables[' top species.csv'], index_col='Species')['Occupancy (%)'].rename('Avg').rename_axis(None)
+    if top_species > len(toplist):
+        toplist = birdstats.loc['Avg'].sort_values(ascending=False)
+    return birdstats, toplist.head(top_species)
+
+
+# run this script directly to check the analyses on the bundled data: every trail is analysed,
+# including the trails outside the occupancy grid, which get an all NaN average
+if __name__ == '__main__':
+    data = load_data()
+    outside = 0
+    for name in data['trail_names']['display'].values():
+        result = analyse_trail(name, data)
+        if not result['grids']:
+            assert result['birdstats'].loc['Avg'].isna().all(), name
+            outside += 1
+    for code in data['species']:
+        analyse_species(code, data)
+    print(f"Checked {len(data['trail_names']['display'])} trails ({outside} outside the grid) and {len(data['species'])} species")
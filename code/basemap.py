@@ -0,0 +1,31 @@
+"""BirdTrails/basemap.py keeps the static map layers already projected for display
+
+Every BirdTrails map shows the same New Zealand outline, lakes, rivers and occupancy grid,
+and cartopy re-projects all of their vertices from the data's UTM coordinates to the map's
+NearsidePerspective projection each time a map is drawn. This script loads those layers
+already projected into the map projection (see projection.py), so maps can draw them
+directly and only the per-query layers (the selected trails) need to be added on top.
+
+Each projected layer is saved in the data/cache folder and rebuilt automatically when its
+source data changes, so the projection cost is paid once per dataset version.
+
+Run this script directly to build every layer.
+
+"""
+
+from projection import build, load_projected, projected_path
+
+
+# the static layers drawn on every map, by dataset name
+LAYERS = ['outline', 'lakes', 'rivers', 'grid']
+
+
+# load every static layer in the map projection, by name
+def load_basemap():
+    return {layer: load_projected(layer) for layer in LAYERS}
+
+
+if __name__ == '__main__':
+    for layer in LAYERS:
+        build(layer)
+        print(f'{layer} -> .../{projected_path(layer)}')
@@ -0,0 +1,156 @@
+"""BirdTrails/batch.py runs the trail and bird analyses for many trails and species at once
+
+This script is the non-interactive version of by_trail.py and by_bird.py. The datasets are
+loaded once, then each trail or species is analysed in turn and its results are written to
+the user folder (and a short summary printed) as soon as it is done:
+
+    <trail> occupancy data.csv   the bird occupancy data for the grids along the trail
+    <trail> top species.csv      the species with the highest average occupancy on the trail
+    <bird> top trails.csv        the trails through the highest occupancy grids for the bird
+
+With --maps the trail overview maps and species maps are also drawn, spread across --jobs
+worker processes (see render.py).
+
+The trails and species can be given in a list file laid out like example_trails_and_birds.txt.txt
+(a 'Trails:' section of trail names and a 'Birds:' section starting each line with a species
+code), or every trail and/or every species can be run with --all, --all-trails or --all-species.
+
+    python batch.py example_trails_and_birds.txt.txt
+    python batch.py --all-species --maps --jobs 4
+
+"""
+
+import os
+import sys
+import argparse
+import profiling
+from analysis import load_data, analyse_trail, analyse_species, result_tables
+from trailsearch import suggest
+
+
+# read a list file into trail names and species codes.
+# lines after 'Trails:' are trail names, lines after 'Birds:' start with a species code, e.g. 'kea (Kea)'
+def read_list(path):
+    trails, species = [], []
+    section = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.lower().rstrip(':') in ('trails', 'birds'):
+                section = line.lower().rstrip(':')
+            elif section == 'trails':
+                trails.append(line)
+            elif section == 'birds':
+                species.append(line.split()[0])
+    return trails, species
+
+
+# analyse each trail in turn, yielding (name, result) as each is done. The tables of trails drawn
+# before are read from the result cache (see analysis.py). result is None if the trail is not in the data set
+def run_trails(names, data, top_species=15):
+    for name in names:
+        try:
+            yield name, analyse_trail(name, data, top_species=top_species, cached=True)
+        except KeyError:
+            yield name, None
+
+
+# analyse each species in turn, yielding (code, result) as each is done.
+# result is None if there is no occupancy data for the species
+def run_species(codes, data, top_grids=50, top_trails=15):
+    for code in codes:
+        try:
+            yield code, analyse_species(code, data, top_grids=top_grids, top_trails=top_trails)
+        except KeyError:
+            yield code, None
+
+
+# write the .csv files for a trail result
+def save_trail(result, out_dir):
+    save_tables(result_tables('trail', result), out_dir)
+
+
+# write the .csv file for a species result
+def save_species(result, out_dir):
+    save_tables(result_tables('species', result), out_dir)
+
+
+# write the .csv tables of a result (see analysis.py)
+def save_tables(tables, out_dir):
+    for name, content in tables.items():
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(content)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the BirdTrails trail and bird analyses for many trails and species.')
+    parser.add_argument('list_file', nargs='?', help="a list of trails and birds, laid out like 'example_trails_and_birds.txt.txt'")
+    parser.add_argument('--all', action='store_true', help='analyse every trail and every species')
+    parser.add_argument('--all-trails', action='store_true', help='analyse every trail')
+    parser.add_argument('--all-species', action='store_true', help='analyse every species')
+    parser.add_argument('--out', default='user', help="folder for the exported .csv files (default 'user')")
+    parser.add_argument('--top-grids', type=int, default=50, help='number of highest occupancy grids checked for trails (default 50)')
+    parser.add_argument('--maps', action='store_true', help='also save the map of each trail and species as a .png')
+    parser.add_argument('--jobs', type=int, default=None, help='number of processes drawing maps (default: one per core)')
+    parser.add_argument('--profile', metavar='TRACE', help='record the time and memory of each stage in a .csv or .json trace file (see profiling.py)')
+    parser.add_argument('--cprofile', action='store_true', help='with --profile, also save the cProfile of the slowest stage')
+    args = parser.parse_args(argv)
+
+    if not (args.list_file or args.all or args.all_trails or args.all_species):
+        parser.error('give a list file, or one of --all, --all-trails or --all-species')
+
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
+
+    # load the datasets once for the whole batch
+    data = load_data()
+
+    trail_names, species = read_list(args.list_file) if args.list_file else ([], [])
+    if args.all or args.all_trails:
+        trail_names = list(dict.fromkeys(data['trails']['name'])) # every trail name, once each
+    if args.all or args.all_species:
+        species = list(data['species'])
+
+    os.makedirs(args.out, exist_ok=True)
+    missing = 0
+    found, results = [], [] # map jobs for the trails and species found in the data, and their results
+
+    for name, result in run_trails(trail_names, data):
+        if result is None:
+            close = suggest(data['trail_names'], name, limit=1)
+            print(f'{name}: trail not found' + (f", did you mean '{close[0]}'?" if close else ''))
+            missing += 1
+            continue
+        save_trail(result, args.out)
+        found.append(('trail', result['name']))
+        results.append(result)
+        top = result['toplist'].head(3)
+        print(f"{name}: {len(result['grids'])} grids, top species " + ', '.join(f'{bird} ({value}%)' for bird, value in top.items()))
+
+    for code, result in run_species(species, data, top_grids=args.top_grids):
+        if result is None:
+            print(f'{code}: species not found')
+            missing += 1
+            continue
+        save_species(result, args.out)
+        found.append(('species', code))
+        results.append(result)
+        best = data['routes']['name'].loc[result['route_ids'][:3]] # routes in order of their best grid
+        print(f"{result['name']}: {len(result['toplist'])} trails, top trails " + ', '.join(best))
+
+    if args.maps and found:
+        from render import render_maps # cartopy is only imported when maps are wanted
+        print(f'\nDrawing {len(found)} maps')
+        for job, path in render_maps(found, n_jobs=args.jobs, out_dir=args.out, top_grids=args.top_grids, results=results):
+            print(f'.../{path}')
+
+    print(f'\nResults saved in .../{args.out}')
+    if args.profile:
+        profiling.summary(profiling.write_trace(args.profile))
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""BirdTrails/benchmark.py times each stage of the BirdTrails analyses, to catch changes that slow them down
+
+This script runs offline on the bundled data in the data folder and times each stage on its own:
+
+    load          reading the trail and grid shapefiles, and their GeoParquet copies (see datacache.py)
+    intersection  building the trail/grid incidence index (see incidence.py)
+    aggregation   the trail and species analyses (see analysis.py) and the all-trails occupancy table
+    figure        drawing the trail and species maps (see render.py)
+    savefig       saving the maps as 300 dpi .png files
+
+The trails and birds are the samples in example_trails_and_birds.txt.txt. The intersection and
+aggregation stages are also run on a synthetic grid, made by splitting every grid cell into
+scale x scale smaller cells (e.g. --scale 4 gives 2.5 km cells), to show how they grow with a
+finer grid.
+
+Each stage is run --repeat times and the fastest and median times are printed and saved as a
+.json file in the benchmarks folder. Pass an earlier results file with --compare to see which
+stages got slower or faster:
+
+    python benchmark.py
+    python benchmark.py --compare benchmarks/20240101-120000.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import numpy as np
+import geopandas as gpd
+import shapely
+import datacache
+from analysis import load_data, analyse_trail, analyse_species
+from batch import read_list
+from incidence import build_incidence
+from occupancy import length_weights, occupancy_matrix
+from species_index import build_species_index
+from proximity import cell_index, near_occupancy
+
+
+# where results are saved, and the sample trails and birds
+RESULTS_DIR = 'benchmarks'
+SAMPLES_PATH = 'example_trails_and_birds.txt.txt'
+
+# a stage that is this many times slower than in the compared results is flagged
+SLOWER = 1.2
+
+
+# run fn repeat times, returning the time of each run (s). If setup is given it is run,
+# untimed, before each run and its result passed to fn
+def timed(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# a grid made by splitting every cell into scale x scale cells. Each new cell takes the
+# occupancy of its cell with a little random noise, so the values are realistic but not repeated
+def synthetic_grid(grid, codes, scale, seed=0):
+    xmin, ymin, xmax, ymax = shapely.bounds(np.asarray(grid.geometry)).T
+    step_x, step_y = (xmax - xmin) / scale, (ymax - ymin) / scale
+    parent = np.repeat(np.arange(len(grid)), scale * scale)
+    i = np.tile(np.repeat(np.arange(scale), scale), len(grid))
+    j = np.tile(np.arange(scale), len(grid) * scale)
+
+    x0, y0 = xmin[parent] + i * step_x[parent], ymin[parent] + j * step_y[parent]
+    cells = shapely.box(x0, y0, x0 + step_x[parent], y0 + step_y[parent])
+
+    noise = np.random.default_rng(seed).normal(0, 0.02, (len(parent), len(codes)))
+    values = np.clip(grid[codes].to_numpy()[parent] + noise, 0, 1)
+    return gpd.GeoDataFrame(dict(zip(codes, values.T)), geometry=cells, crs=grid.crs)
+
+
+# the benchmarked stages as (name, function, setup), for the sample trails and species and a grid scale
+def stages(trail_names, codes, scale, render=True):
+    data = load_data()
+    trails, grid = data['trails'], data['grid']
+    incidence = data['incidence']
+    synthetic = synthetic_grid(grid, data['species'], scale)
+
+    yield 'load/shapefile trails', lambda: gpd.read_file(os.path.abspath(datacache.DATASETS['trails'])), None
+    yield 'load/shapefile grid', lambda: gpd.read_file(os.path.abspath(datacache.DATASETS['grid'])), None
+    yield 'load/parquet trails', lambda: datacache.load('trails'), None
+    yield 'load/parquet grid', lambda: datacache.load('grid'), None
+
+    yield 'intersection/incidence', lambda: build_incidence(trails, grid), None
+    yield f'intersection/incidence x{scale}', lambda: build_incidence(trails, synthetic), None
+
+    yield 'aggregation/trails', lambda: [analyse_trail(name, data) for name in trail_names], None
+    yield 'aggregation/species', lambda: [analyse_species(code, data) for code in codes], None
+    yield 'aggregation/occupancy table', lambda: occupancy_matrix(length_weights(incidence), grid, data['species']), None
+    yield 'aggregation/species index', lambda: build_species_index(incidence, grid, data['species']), None
+    yield 'aggregation/proximity 0-10 km', lambda: near_occupancy(cell_index(grid), grid, data['species'], np.asarray(trails.geometry), (0, 1, 2, 5, 10), 'linear'), None
+
+    synthetic_incidence = build_incidence(trails, synthetic)
+    yield f'aggregation/occupancy table x{scale}', lambda: occupancy_matrix(length_weights(synthetic_incidence), synthetic, data['species']), None
+    yield f'aggregation/species index x{scale}', lambda: build_species_index(synthetic_incidence, synthetic, data['species']), None
+
+    if not render:
+        return
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from render import load_base, trail_map, species_map, save_map # cartopy is only imported when maps are timed
+
+    base = load_base()
+    results = [analyse_trail(name, base) for name in trail_names] + [analyse_species(code, base) for code in codes]
+    draw = lambda result: trail_map(result, base) if 'birdstats' in result else species_map(result, base)
+
+    def figure():
+        for result in results:
+            fig = draw(result)
+            fig.canvas.draw() # lay out the figure, as saving would
+            plt.close(fig)
+    yield 'figure/maps', figure, None
+
+    # saving closes the figures, so each run saves freshly drawn ones (drawn untimed)
+    def savefig(figures):
+        with tempfile.TemporaryDirectory() as folder:
+            for k, fig in enumerate(figures):
+                save_map(fig, os.path.join(folder, f'{k}.png'))
+    yield 'savefig/maps', savefig, lambda: [draw(result) for result in results]
+
+
+# print the times, and the change from compared results if given
+def report(results, compared=None):
+    for name, result in results.items():
+        line = f"{name:40} min {result['min']:8.3f} s   median {result['median']:8.3f} s"
+        if compared and name in compared:
+            ratio = result['min'] / compared[name]['min']
+            line += f'   {ratio:5.2f}x' + ('  SLOWER' if ratio > SLOWER else '')
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each stage of the BirdTrails analyses on the bundled data.')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each stage (default 3)')
+    parser.add_argument('--scale', type=int, default=4, help='split each grid cell into scale x scale cells for the synthetic grid (default 4)')
+    parser.add_argument('--no-render', action='store_true', help='skip the figure and savefig stages')
+    parser.add_argument('--stage', help="only run stages starting with this, e.g. 'aggregation'")
+    parser.add_argument('--compare', help='an earlier results .json file to compare with')
+    parser.add_argument('--out', default=RESULTS_DIR, help=f"folder for the results .json file (default '{RESULTS_DIR}')")
+    args = parser.parse_args(argv)
+
+    trail_names, codes = read_list(SAMPLES_PATH)
+    compared = None
+    if args.compare:
+        with open(args.compare) as f:
+            compared = json.load(f)['results']
+
+    results = {}
+    for name, fn, setup in stages(trail_names, codes, args.scale, render=not args.no_render):
+        if args.stage and not name.startswith(args.stage):
+            continue
+        times = timed(fn, args.repeat, setup)
+        results[name] = {'min': min(times), 'median': statistics.median(times), 'times': times}
+        report({name: results[name]}, compared)
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'scale': args.scale,
+            'results': results,
+        }, f, indent=1)
+    print(f'\nResults saved as .../{path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""BirdTrails/datacache.py keeps a fast binary copy of the shapefiles used by BirdTrails
+
+Reading a shapefile means parsing its .dbf attribute table and every geometry record each
+time a script is started. This script converts each dataset, on first use, to GeoParquet
+(columns stored separately, geometry as WKB) in the data/cache folder, and loads that copy
+on later runs.
+
+Only the columns asked for are read from the GeoParquet file, so a script that just draws
+the rivers never reads the river attribute table. A cached copy is rebuilt automatically
+whenever any of its source files (.shp, .dbf, .shx, .prj, ...) is newer than the cache.
+
+Run this script directly to build the cache for every dataset.
+
+"""
+
+import os
+import glob
+import geopandas as gpd
+
+
+# the datasets used by BirdTrails, by short name
+DATASETS = {
+    'trails': 'data/Trails.shp',
+    'grid': 'data/SpeciesData.shp',
+    'outline': 'data/NZ_outline.shp',
+    'lakes': 'data/Lakes.shp',
+    'rivers': 'data/Rivers.shp',
+    'landuse': 'data/lu/LandUse.shp',
+}
+CACHE_DIR = 'data/cache'
+
+# the species attribute table (common names, codes, ...), a plain .csv read with pandas
+ATTRIBUTES_PATH = 'data/SpeciesAttributes.csv'
+
+
+# the cached GeoParquet file for a dataset
+def cache_path(name):
+    return os.path.join(CACHE_DIR, f'{name}.parquet')
+
+
+# the most recent modification time of all the files making up a shapefile
+def source_mtime(name):
+    stem = os.path.splitext(DATASETS[name])[0]
+    return max(os.path.getmtime(path) for path in glob.glob(f'{stem}.*'))
+
+
+# check the cached copy exists and is newer than its source files
+def is_current(name):
+    path = cache_path(name)
+    return os.path.exists(path) and os.path.getmtime(path) > source_mtime(name)
+
+
+# convert a shapefile to GeoParquet. Written to a temporary file of this process first, so another
+# process never reads a half written cache, and two processes building it at once do not collide
+def build(name):
+    data = gpd.read_file(os.path.abspath(DATASETS[name]))
+    path = cache_path(name)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    data.to_parquet(f'{path}.tmp{os.getpid()}', index=False)
+    os.replace(f'{path}.tmp{os.getpid()}', path)
+    return data
+
+
+# load a dataset by name, optionally only some of its columns (the geometry is always loaded).
+# the cache is built or refreshed first if needed
+def load(name, columns=None):
+    if not is_current(name):
+        data = build(name)
+        return data if columns is None else data[[c for c in columns if c != 'geometry'] + ['geometry']]
+
+    if columns is not None:
+        columns = [c for c in columns if c != 'geometry'] + ['geometry']
+    return gpd.read_parquet(cache_path(name), columns=columns)
+
+
+if __name__ == '__main__':
+    for name in DATASETS:
+        build(name)
+        print(f'{name}: {DATASETS[name]} -> .../{cache_path(name)}')
@@ -5,23 +5,37 @@ of Conservation trails in New Zealand and display them on an interactive
 HTML map. This will allow users to browse trails that can then be analysed
 using by_bird.py
 
+Run with '--tiles' to export a tiled map instead (see tiles.py), which stays
+small and quick to open however many trails there are:
+
+    python find_trail.py --tiles
+
 
 """
 
-import geopandas as gpd
+import sys
 import folium
+import datacache
+from tiles import export_tiles
 
  # load the Trail dataset and tidy the information for display on the map
-data = gpd.read_file('data/Trails.shp') # load the data
+data = datacache.load('trails', columns=['name', 'difficulty', 'completion', 'SHAPE_Leng']) # load the data, only the columns shown on the map
 data['length'] = data['SHAPE_Leng'] / 1000 # convert the lenth value from m to km
 data['length'] = data['length'].round(2)  # round length to 2 decimal places
 data['length'] = data['length'].astype(str) + ' km'  # change length data type to string and adds unit
+data = data[data.geometry.length > 0.001] # drop trails without any length
+
+if '--tiles' in sys.argv[1:]:
+    # export the trails as simplified tiles per zoom level, a tooltip index and a small map page
+    count = export_tiles(data, 'user/Trail_tiles.html')
+    print(f'Map saved as .../user/Trail_tiles.html, with {count} trail tiles in .../user/Trail_tiles') # confirms to user where the map has been saved
+    sys.exit()
 
 m = folium.Map([-40, 174], zoom_start=5) # create map, focused on New Zealand
 
 # processes the trail data as a GeoJson layer
 # adapted from here https://anitagraser.com/2019/10/31/interactive-plots-for-geopandas-geodataframe-of-linestrings/
-data_geojson = folium.GeoJson(data[data.geometry.length > 0.001],
+data_geojson = folium.GeoJson(data,
   style_function=lambda feature: {
    'weight': 3,
    'color': 'red'
@@ -37,4 +51,3 @@ data_geojson.add_to(m)
 
 m.save('user/Trail_maps.html') # saves the map
 print('Map saved as .../user/Trail_maps.html') # confirms to user where the map has been saved
-
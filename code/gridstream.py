@@ -0,0 +1,121 @@
+"""BirdTrails/gridstream.py reads only the part of the occupancy grid near the trails being queried
+
+The other scripts load the whole of SpeciesData.shp, every cell with all ~65 float64 species
+columns. That is fine for the 10 km national grid, but a finer grid (1 km cells, more species,
+or a column per survey period) would not fit comfortably in memory. This script streams the grid
+from the shapefile in batches of rows instead (Arrow record batches, see pyogrio), limited to the
+bounding box of the trails being queried. From each batch it keeps only the cells within a
+distance of the trails, and stores the species columns compactly:
+
+    float32    occupancy as a fraction, half the memory of float64
+    uint8      occupancy as a whole percent (0-100, 255 for no data), an eighth of float64
+
+So memory grows with the area around the query rather than with the size of the national grid.
+The cells keep their position in the national grid as their index, so they can be matched with
+the trail/grid incidence index (see incidence.py) and analysis.analyse_trail.
+
+Run this script with a trail name to see how many cells are kept and the memory they use:
+
+    python gridstream.py "Milford Track" --dtype uint8
+
+"""
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyogrio.raw import open_arrow
+import datacache
+from occupancy import ATTRIBUTES_PATH
+
+
+# the grid shapefile, and the number of rows read at a time
+GRID_PATH = datacache.DATASETS['grid']
+CHUNK_ROWS = 10000
+
+# the value stored for a cell with no occupancy data in a uint8 column
+NODATA = 255
+
+
+# species occupancy values (fractions) in a compact type: 'float32' fractions, or 'uint8'
+# whole percents with NODATA for missing values. 'float64' leaves them as they are
+def pack(values, dtype='float32'):
+    values = np.asarray(values, dtype=np.float64)
+    if dtype == 'uint8':
+        return np.where(np.isnan(values), NODATA, np.round(values * 100)).astype(np.uint8)
+    return values.astype(dtype)
+
+
+# packed occupancy values back to float64 fractions, with NaN for missing values
+def unpack(values):
+    values = np.asarray(values)
+    if values.dtype == np.uint8:
+        return np.where(values == NODATA, np.nan, values / 100)
+    return values.astype(np.float64)
+
+
+# the species codes with a column in the grid shapefile, in column order
+def grid_species(path=GRID_PATH):
+    known = set(pd.read_csv(ATTRIBUTES_PATH)['Code'])
+    with open_arrow(path, batch_size=1) as (meta, _):
+        return [field for field in meta['fields'] if field in known]
+
+
+# read the grid a batch of rows at a time, optionally only the cells overlapping a bounding box
+# (xmin, ymin, xmax, ymax) and only some columns. Yields a GeoDataFrame per batch, indexed by
+# the cell's position in the national grid, with the species columns packed as dtype
+def iter_grid(columns=None, bbox=None, chunk_rows=CHUNK_ROWS, dtype='float32', path=GRID_PATH):
+    species = set(grid_species(path))
+    with open_arrow(path, batch_size=chunk_rows, columns=columns, bbox=bbox, return_fids=True, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            cell_ids = batch.column(meta['fid_column']).to_numpy()
+            chunk = {}
+            for name in batch.schema.names:
+                if name in (meta['fid_column'], geometry_name):
+                    continue
+                values = batch.column(name).to_numpy(zero_copy_only=False)
+                chunk[name] = pack(values, dtype) if name in species else values
+            geometry = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+            yield gpd.GeoDataFrame(chunk, geometry=geometry, crs=meta['crs'], index=pd.Index(cell_ids, name='cell'))
+
+
+# the grid cells within distance (m) of any of the geometries (usually trails), streamed in batches
+# of chunk_rows. Only the footprint's bounding box is read from the file, and of that only the
+# cells near the geometries are kept
+def load_grid_near(geoms, distance=0, columns=None, dtype='float32', chunk_rows=CHUNK_ROWS, path=GRID_PATH):
+    footprint = np.asarray(geoms)
+    if distance:
+        footprint = shapely.buffer(footprint, distance)
+    tree = shapely.STRtree(footprint)
+
+    kept = []
+    for chunk in iter_grid(columns, tuple(shapely.total_bounds(footprint)), chunk_rows, dtype, path):
+        cell_idx, _ = tree.query(np.asarray(chunk.geometry), predicate='intersects')
+        kept.append(chunk.iloc[np.unique(cell_idx)])
+
+    if not kept:
+        # no cells near the geometries, an empty grid still has the species columns
+        empty = {column: np.array([], dtype=dtype) for column in (columns or grid_species(path))}
+        return gpd.GeoDataFrame(empty, geometry=[], index=pd.Index([], name='cell'))
+    return pd.concat(kept).sort_index()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stream the occupancy grid cells near a trail.')
+    parser.add_argument('trail', help="a trail name, for example 'Milford Track'")
+    parser.add_argument('--distance', type=float, default=0, help='keep cells within this distance of the trail (m, default 0)')
+    parser.add_argument('--dtype', choices=['float64', 'float32', 'uint8'], default='float32', help='type of the species columns (default float32)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help=f'rows read at a time (default {CHUNK_ROWS})')
+    args = parser.parse_args()
+
+    trails = datacache.load('trails', columns=['name'])
+    selected = trails[trails['name'] == args.trail]
+    if selected.empty:
+        parser.exit(1, f"The trail '{args.trail}' does not exist in the geodatabase\n")
+
+    cells = load_grid_near(selected.geometry, args.distance, dtype=args.dtype, chunk_rows=args.chunk_rows)
+    print(f'{len(cells)} grid cells near {args.trail}: {cells.index.tolist()}')
+    print(f'Memory: {cells.memory_usage(deep=True).sum() / 1024:.1f} KB')
@@ -0,0 +1,100 @@
+"""BirdTrails/incidence.py builds a trail to grid incidence index shared by the analysis tools
+
+This script works out, once, which occupancy grid cells each Department of Conservation
+trail passes through, and how many metres of the trail lie inside each of those cells.
+The result is saved as a sparse trail x cell matrix (CSR format) so that by_trail.py and
+by_bird.py can answer their queries with a lookup instead of Shapely 'intersects' tests.
+
+Rows of the matrix are trail positions in Trails.shp, columns are grid positions in
+SpeciesData.shp, and each stored value is the overlap length (m) of that trail in that cell.
+A trail that only touches the edge of a cell is stored with a length of 0, so the stored
+entries (not the values) are the incidence.
+
+Run this script directly to (re)build the index, otherwise it is built on first use.
+
+"""
+
+import os
+import numpy as np
+import scipy.sparse as sparse
+import shapely
+from spatial_join import build_tree, join
+import datacache
+
+
+# source datasets and the location of the saved index
+TRAILS_PATH = datacache.DATASETS['trails']
+GRID_PATH = datacache.DATASETS['grid']
+INCIDENCE_PATH = 'data/cache/incidence.npz'
+
+
+# build the sparse trail x cell matrix of overlap lengths
+def build_incidence(trails, grid):
+    # find every (trail, cell) pair that intersects with one bulk query of the trail R-tree
+    cell_idx, trail_idx = join(build_tree(trails['geometry']), grid['geometry'])
+
+    # clip the trails to their cells in one vectorised call and measure what is left
+    trail_geoms = np.asarray(trails['geometry'])[trail_idx]
+    cell_geoms = np.asarray(grid['geometry'])[cell_idx]
+    lengths = shapely.length(shapely.intersection(trail_geoms, cell_geoms))
+
+    return sparse.csr_matrix((lengths, (trail_idx, cell_idx)), shape=(len(trails), len(grid)))
+
+
+# recompute the rows of some trails and the columns of some cells (e.g. after their geometry
+# changed), keeping every other entry. The index must already have one row per trail
+def update_incidence(incidence, trails, grid, trail_ids=(), cell_ids=()):
+    trail_ids, cell_ids = np.asarray(trail_ids, dtype=np.int64), np.asarray(cell_ids, dtype=np.int64)
+    kept = sparse.coo_matrix(incidence)
+    keep = ~(np.isin(kept.row, trail_ids) | np.isin(kept.col, cell_ids))
+    parts = [(kept.row[keep], kept.col[keep], kept.data[keep])]
+
+    if len(trail_ids):
+        found = sparse.coo_matrix(build_incidence(trails.iloc[trail_ids], grid))
+        parts.append((trail_ids[found.row], found.col, found.data))
+    if len(cell_ids):
+        # the changed trails were found above, so only the other trails are added here
+        found = sparse.coo_matrix(build_incidence(trails, grid.iloc[cell_ids]))
+        other = ~np.isin(found.row, trail_ids)
+        parts.append((found.row[other], cell_ids[found.col[other]], found.data[other]))
+
+    rows, cols, lengths = (np.concatenate(values) for values in zip(*parts))
+    return sparse.csr_matrix((lengths, (rows, cols)), shape=(len(trails), len(grid)))
+
+
+# check the saved index is newer than both source shapefiles
+def incidence_is_current(path=INCIDENCE_PATH):
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(os.path.getmtime(source) < built for source in (TRAILS_PATH, GRID_PATH))
+
+
+# load the saved index, building and saving it first if it is missing or out of date
+def load_incidence(trails, grid, path=INCIDENCE_PATH):
+    if incidence_is_current(path):
+        incidence = sparse.load_npz(path).tocsr()
+        if incidence.shape == (len(trails), len(grid)):
+            return incidence
+
+    incidence = build_incidence(trails, grid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sparse.save_npz(path, incidence)
+    return incidence
+
+
+# return the sorted grid cell ids crossed by any of the given trails
+def cells_for_trails(incidence, trail_ids):
+    return np.unique(incidence[np.asarray(trail_ids)].indices)
+
+
+if __name__ == '__main__':
+    trails = datacache.load('trails', columns=['geometry'])
+    grid = datacache.load('grid', columns=['geometry'])
+
+    incidence = build_incidence(trails, grid)
+    os.makedirs(os.path.dirname(INCIDENCE_PATH), exist_ok=True)
+    sparse.save_npz(INCIDENCE_PATH, incidence)
+
+    print(f'Incidence index saved: {incidence.shape[0]} trails x {incidence.shape[1]} grid cells, {incidence.nnz} overlaps')
+    print(f'.../{INCIDENCE_PATH}')
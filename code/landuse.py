@@ -0,0 +1,187 @@
+"""BirdTrails/landuse.py works out the land use along every trail from the LandUse layer
+
+LandUse.shp holds seven land use classes (Forest, Grassland, Cropland, Water, Wetland, Urban,
+Bare), each as one very large MultiPolygon with tens of thousands of vertices. Testing a trail
+against a whole class means walking every one of those vertices, which takes about 20 ms per
+trail and class. This script first subdivides the classes into small pieces (each part of a
+MultiPolygon, split in half again and again until no piece has more than MAX_VERTICES vertices),
+puts the pieces in an R-tree, and then clips every trail to the pieces it crosses in one bulk
+query, and those clipped lines to the occupancy grid cells. The result is
+
+    the length (m) of every trail in each land use class, from the first clip, so parts of
+    trails outside the occupancy grid are counted too
+    a table of trail, land use class, grid cell, length (m), from the second
+
+for every trail at once, saved in the data/cache folder and rebuilt when the trails, the grid
+or the land use data change. From it:
+
+    landuse_profile(overlay, trail_ids)                  the share of a trail's length in each class
+    landuse_occupancy(overlay, grid, codes, trail_ids)   the bird occupancy along the trail in each
+                                                         class, weighted by the length in each grid
+
+Run this script directly to (re)build the overlay, or with a trail name to see its land use:
+
+    python landuse.py "Milford Track"
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import shapely
+import datacache
+
+
+# location of the saved overlay, and the most vertices a subdivided land use piece may have
+OVERLAY_PATH = os.path.join(datacache.CACHE_DIR, 'landuse_overlay.npz')
+MAX_VERTICES = 256
+
+# the class of trail lengths outside every land use class (e.g. along the coast)
+UNCLASSIFIED = 'Unclassified'
+
+
+# split polygons into pieces of at most max_vertices vertices, cutting each too large piece in
+# half across its longer side. Returns the pieces and the position of the polygon each came from
+def subdivide(geoms, max_vertices=MAX_VERTICES):
+    parts, source = shapely.get_parts(np.asarray(geoms), return_index=True)
+    pieces, pieces_source = [], []
+    stack = list(zip(parts, source))
+    while stack:
+        geom, i = stack.pop()
+        if shapely.get_num_coordinates(geom) <= max_vertices:
+            pieces.append(geom)
+            pieces_source.append(i)
+            continue
+
+        xmin, ymin, xmax, ymax = geom.bounds
+        if xmax - xmin >= ymax - ymin:
+            mid = (xmin + xmax) / 2
+            halves = [(xmin, ymin, mid, ymax), (mid, ymin, xmax, ymax)]
+        else:
+            mid = (ymin + ymax) / 2
+            halves = [(xmin, ymin, xmax, mid), (xmin, mid, xmax, ymax)]
+        for half in halves:
+            # keep only the polygons of each half (clipping can also leave lines along the cut)
+            stack += [(part, i) for part in shapely.get_parts(shapely.clip_by_rect(geom, *half)) if shapely.get_type_id(part) == 3]
+    return np.array(pieces), np.array(pieces_source, dtype=np.int64)
+
+
+# clip lines to polygons with one bulk R-tree query. Returns the line and polygon position of
+# each overlap, and the clipped lines (overlaps only touching, with no length, are dropped)
+def clip_lines(lines, polygons):
+    line_idx, polygon_idx = shapely.STRtree(polygons).query(lines, predicate='intersects')
+    clipped = shapely.intersection(lines[line_idx], polygons[polygon_idx])
+    keep = shapely.length(clipped) > 0
+    return line_idx[keep], polygon_idx[keep], clipped[keep]
+
+
+# the trail x land use x grid cell overlay of lengths
+def build_overlay(trails, grid, landuse):
+    classes = landuse.sort_values('LUID')
+    pieces, piece_class = subdivide(classes.geometry)
+
+    # clip the trails to the land use pieces, then those pieces of trail to the grid cells
+    trail_idx, piece_idx, trail_pieces = clip_lines(np.asarray(trails.geometry), pieces)
+    part_idx, cell_idx, trail_cells = clip_lines(trail_pieces, np.asarray(grid.geometry))
+
+    # the length of each trail in each class, before the clip to the grid drops what is outside it
+    n_classes = len(classes)
+    class_length = np.bincount(trail_idx * n_classes + piece_class[piece_idx], weights=shapely.length(trail_pieces),
+                               minlength=len(trails) * n_classes).reshape(len(trails), n_classes)
+
+    return {
+        'class_length': class_length,
+        'trail': trail_idx[part_idx],
+        'landuse': piece_class[piece_idx][part_idx],
+        'cell': cell_idx,
+        'length': shapely.length(trail_cells),
+        'trail_length': shapely.length(np.asarray(trails.geometry)), # total length of each trail
+        'classes': classes['Category'].to_numpy(dtype=str),
+    }
+
+
+# check the saved overlay is newer than the trail, grid and land use data
+def overlay_is_current(path=OVERLAY_PATH):
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(datacache.source_mtime(name) < built for name in ('trails', 'grid', 'landuse'))
+
+
+# load the saved overlay, building and saving it first if it is missing or out of date
+def load_overlay(trails, grid, path=OVERLAY_PATH):
+    if overlay_is_current(path):
+        with np.load(path) as saved:
+            overlay = {key: saved[key] for key in saved.files}
+        if len(overlay['trail_length']) == len(trails) and 'class_length' in overlay:
+            return overlay
+
+    overlay = build_overlay(trails, grid, datacache.load('landuse', columns=['LUID', 'Category']))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(f'{path}.tmp{os.getpid()}.npz', **overlay)
+    os.replace(f'{path}.tmp{os.getpid()}.npz', path)
+    return overlay
+
+
+# the overlay rows of some trails
+def trail_rows(overlay, trail_ids):
+    return np.isin(overlay['trail'], np.asarray(trail_ids))
+
+
+# the percent of the trails' length in each land use class (and outside every class)
+def landuse_profile(overlay, trail_ids):
+    lengths = overlay['class_length'][np.asarray(trail_ids)].sum(axis=0)
+    total = overlay['trail_length'][np.asarray(trail_ids)].sum()
+    profile = pd.Series(lengths, index=overlay['classes'])
+    profile[UNCLASSIFIED] = max(total - lengths.sum(), 0)
+    return (profile / total * 100).round(2) if total > 0 else profile * np.nan
+
+
+# the percent of every trail's length in each land use class, as a trails x classes table
+def all_profiles(overlay):
+    table = pd.DataFrame(overlay['class_length'], columns=overlay['classes'])
+    table[UNCLASSIFIED] = np.maximum(overlay['trail_length'] - table.sum(axis=1), 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return table.div(overlay['trail_length'], axis=0).mul(100).round(2)
+
+
+# the bird occupancy (percent) along the trails in each land use class, weighting each grid by
+# the length of trail in that class inside it. A classes x species table, classes the trails do
+# not pass through are left out
+def landuse_occupancy(overlay, grid, codes, trail_ids):
+    rows = trail_rows(overlay, trail_ids)
+    landuse, cells, lengths = overlay['landuse'][rows], overlay['cell'][rows], overlay['length'][rows]
+    values = grid[codes].to_numpy(dtype=np.float64)[cells] * 100
+
+    found = np.unique(landuse)
+    table = [(values[landuse == k] * lengths[landuse == k, None]).sum(axis=0) / lengths[landuse == k].sum() for k in found]
+    return pd.DataFrame(table, index=overlay['classes'][found], columns=codes).round(2)
+
+
+if __name__ == '__main__':
+    import sys
+
+    trails = datacache.load('trails', columns=['name'])
+    grid = datacache.load('grid')
+    if len(sys.argv) < 2:
+        overlay = build_overlay(trails, grid, datacache.load('landuse', columns=['LUID', 'Category']))
+        os.makedirs(os.path.dirname(OVERLAY_PATH), exist_ok=True)
+        np.savez(OVERLAY_PATH, **overlay)
+        print(f"Land use overlay saved: {len(trails)} trails, {len(overlay['classes'])} land use classes, {len(overlay['length'])} overlaps")
+        print(f'.../{OVERLAY_PATH}')
+        sys.exit()
+
+    selected = trails.index[trails['name'] == sys.argv[1]]
+    if selected.empty:
+        sys.exit(f"The trail '{sys.argv[1]}' does not exist in the geodatabase")
+    overlay = load_overlay(trails, grid)
+    print(f'\nLand use along {sys.argv[1]} (% of length)')
+    print(landuse_profile(overlay, selected).to_string())
+
+    # the occupancy of the five most common birds along the trail, in each land use
+    from occupancy import ATTRIBUTES_PATH, species_codes
+    bird_details = pd.read_csv(ATTRIBUTES_PATH)
+    occupancy = landuse_occupancy(overlay, grid, species_codes(grid, bird_details), selected)
+    top = occupancy.mean().sort_values(ascending=False).index[:5]
+    print(f'\nBird occupancy along {sys.argv[1]} by land use (%)')
+    print(occupancy[top].rename(columns=dict(zip(bird_details['Code'], bird_details['Common_name']))).to_string())
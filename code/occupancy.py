@@ -0,0 +1,106 @@
+"""BirdTrails/occupancy.py builds the mean bird occupancy of every trail for every species
+
+This script is the batch version of the statistics in by_trail.py. Instead of extracting the
+grids along one trail and averaging them, it averages the grids for every Department of
+Conservation trail in one pass: the trail/grid incidence index from incidence.py is turned
+into a sparse trail x grid weight matrix and multiplied by the grid x species occupancy
+array from SpeciesData.dbf.
+
+By default each grid is weighted by the length of trail inside it (the clipped lengths are
+already stored in the incidence index), so a grid a track clips for 5 m counts far less than
+one it crosses for 5 km. Run 'python occupancy.py mean' for the unweighted grid average.
+
+The result (a trails x species array of mean occupancy, as a fraction) is saved with the
+trail names and species codes as a single .npz file that other tools can load.
+
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from incidence import load_incidence
+import datacache
+
+
+# location of the species attribute table (see datacache.py) and the saved occupancy matrix
+ATTRIBUTES_PATH = datacache.ATTRIBUTES_PATH
+OCCUPANCY_PATH = 'data/cache/occupancy.npz'
+
+
+# species codes that have an occupancy column in the grid, in grid column order
+def species_codes(grid, bird_details):
+    known = set(bird_details['Code'])
+    return [column for column in grid.columns if column in known]
+
+
+# turn the incidence index into weights that average the grids along each trail.
+# every grid a trail touches gets an equal share, trails without grids get no weights
+def mean_weights(incidence):
+    weights = sparse.csr_matrix(incidence, copy=True)
+    weights.data[:] = 1
+    counts = np.diff(weights.indptr)
+    scale = np.divide(1.0, counts, out=np.zeros(len(counts)), where=counts > 0)
+    return sparse.diags(scale) @ weights
+
+
+# turn the incidence index into weights proportional to the length of trail inside each grid.
+# trails that only touch grid edges have no length inside any grid, so fall back to an equal share
+def length_weights(incidence):
+    lengths = sparse.csr_matrix(incidence)
+    totals = np.asarray(lengths.sum(axis=1)).ravel()
+    scale = np.divide(1.0, totals, out=np.zeros(len(totals)), where=totals > 0)
+    edge_only = sparse.diags((totals == 0).astype(float))
+    return sparse.csr_matrix(sparse.diags(scale) @ lengths + edge_only @ mean_weights(incidence))
+
+
+# the weighting schemes available to occupancy_matrix, by name
+WEIGHTINGS = {'length': length_weights, 'mean': mean_weights}
+
+
+# multiply the trail weights by the grid x species array, giving trails x species.
+# trails that do not cross any grid are set to NaN rather than 0
+def occupancy_matrix(weights, grid, codes):
+    values = grid[codes].to_numpy(dtype=np.float64)
+    matrix = np.asarray(weights @ values)
+    matrix[np.diff(weights.indptr) == 0] = np.nan
+    return matrix
+
+
+# recompute some rows (trails) of a matrix in place, e.g. after those trails or their grids changed
+def update_occupancy(matrix, weights, grid, codes, trail_ids):
+    trail_ids = np.asarray(trail_ids, dtype=np.int64)
+    if len(trail_ids):
+        matrix[trail_ids] = occupancy_matrix(sparse.csr_matrix(weights[trail_ids]), grid, codes)
+    return matrix
+
+
+# save the matrix with its row (trail) and column (species) labels
+def save_occupancy(matrix, trail_names, codes, weighting='length', path=OCCUPANCY_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, occupancy=matrix, trails=np.asarray(trail_names, dtype=str), species=np.asarray(codes, dtype=str), weighting=weighting)
+
+
+# load the saved matrix as a DataFrame, one row per trail and one column per species code
+def load_occupancy(path=OCCUPANCY_PATH):
+    with np.load(path) as saved:
+        return pd.DataFrame(saved['occupancy'], index=saved['trails'], columns=saved['species'])
+
+
+if __name__ == '__main__':
+    trails = datacache.load('trails', columns=['name'])
+    grid = datacache.load('grid')
+    bird_details = pd.read_csv(ATTRIBUTES_PATH)
+
+    weighting = sys.argv[1] if len(sys.argv) > 1 else 'length'
+    if weighting not in WEIGHTINGS:
+        sys.exit(f"Unknown weighting '{weighting}', choose from: {', '.join(WEIGHTINGS)}")
+
+    codes = species_codes(grid, bird_details)
+    weights = WEIGHTINGS[weighting](load_incidence(trails, grid))
+    matrix = occupancy_matrix(weights, grid, codes)
+    save_occupancy(matrix, trails['name'], codes, weighting)
+
+    print(f'Occupancy matrix saved: {matrix.shape[0]} trails x {matrix.shape[1]} species ({weighting} weighted)')
+    print(f'.../{OCCUPANCY_PATH}')
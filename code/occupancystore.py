@@ -0,0 +1,120 @@
+"""BirdTrails/occupancystore.py keeps the grid x species occupancy values in a compact memory-mapped file
+
+SpeciesData.dbf stores every occupancy value as a text encoded number, and loading the grid turns
+them into a float64 DataFrame column per species. This script converts them once into a single
+cells x species array on disk:
+
+    uint8      occupancy as a whole percent (0-100, 255 for no data), 1/8 of the float64 size
+    float16    occupancy as a fraction (about 3 significant figures), 1/4 of the float64 size
+
+with a small JSON header beside it recording the type, the shape and the column of each species
+code (in SpeciesAttributes.csv order). The same packing is used as in gridstream.py, so the values
+are read back with gridstream.unpack().
+
+The array is opened memory-mapped rather than read, so only the pages holding the rows that are
+used (e.g. the cells along one trail) are read from disk, slicing rows does not copy them, and
+every worker process opening the store shares the same copy through the operating system's
+file cache. The store is rebuilt automatically when the grid or the species attributes change.
+
+Run this script directly to build the store, e.g. 'python occupancystore.py float16'.
+
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+import pyogrio
+from pyogrio.raw import open_arrow
+import datacache
+from gridstream import GRID_PATH, iter_grid, pack
+from occupancy import ATTRIBUTES_PATH
+
+
+# the types the store can be kept in
+DTYPES = ('uint8', 'float16')
+
+
+# the array and header files of the store for a type
+def store_paths(dtype='uint8'):
+    stem = os.path.join(datacache.CACHE_DIR, f'occupancy_{dtype}')
+    return f'{stem}.npy', f'{stem}.json'
+
+
+# the species codes of SpeciesAttributes.csv that have a column in the grid, in attribute table order
+def store_species(path=GRID_PATH):
+    with open_arrow(path, batch_size=1) as (meta, _):
+        fields = set(meta['fields'])
+    return [code for code in pd.read_csv(ATTRIBUTES_PATH)['Code'] if code in fields]
+
+
+# convert the grid to a store, reading it a batch of rows at a time so the float64 values
+# are never all in memory at once. Written to temporary files first, then moved into place
+def build_store(dtype='uint8'):
+    if dtype not in DTYPES:
+        raise ValueError(f"The store type must be one of {', '.join(DTYPES)}")
+    array_path, header_path = store_paths(dtype)
+    codes = store_species()
+    n_cells = pyogrio.read_info(GRID_PATH)['features']
+
+    os.makedirs(datacache.CACHE_DIR, exist_ok=True)
+    values = np.lib.format.open_memmap(f'{array_path}.tmp{os.getpid()}', mode='w+', dtype=dtype, shape=(n_cells, len(codes)))
+    for chunk in iter_grid(columns=codes, dtype='float64'):
+        values[chunk.index.to_numpy()] = pack(chunk[codes].to_numpy(), dtype)
+    values.flush()
+    del values
+
+    header = {'dtype': dtype, 'shape': [n_cells, len(codes)], 'columns': {code: offset for offset, code in enumerate(codes)}}
+    with open(f'{header_path}.tmp{os.getpid()}', 'w') as f:
+        json.dump(header, f, indent=1)
+    os.replace(f'{array_path}.tmp{os.getpid()}', array_path)
+    os.replace(f'{header_path}.tmp{os.getpid()}', header_path)
+    return header
+
+
+# check the store exists and is newer than the grid and the species attributes
+def store_is_current(dtype='uint8'):
+    array_path, header_path = store_paths(dtype)
+    if not (os.path.exists(array_path) and os.path.exists(header_path)):
+        return False
+    built = min(os.path.getmtime(array_path), os.path.getmtime(header_path))
+    return datacache.source_mtime('grid') < built and os.path.getmtime(ATTRIBUTES_PATH) < built
+
+
+# open the store memory-mapped (read only), building it first if needed.
+# returns {'dtype', 'columns': {species code: column}, 'values': the cells x species array}
+def open_store(dtype='uint8'):
+    if not store_is_current(dtype):
+        build_store(dtype)
+    array_path, header_path = store_paths(dtype)
+    with open(header_path) as f:
+        header = json.load(f)
+    header['values'] = np.load(array_path, mmap_mode='r')
+    return header
+
+
+# the packed values of some species in some cells, as a cells x species array.
+# a range of cells (a slice) is a view of the file, a list of cells is copied
+def store_values(store, cells=slice(None), codes=None):
+    values = store['values'][cells]
+    if codes is None:
+        return values
+    return values[:, [store['columns'][code] for code in codes]]
+
+
+# the store as a DataFrame of species columns indexed by cell id, without copying the values.
+# it can be used as data['grid'] by analysis.analyse_trail
+def store_frame(store):
+    return pd.DataFrame(store['values'], columns=list(store['columns']), copy=False)
+
+
+if __name__ == '__main__':
+    dtype = sys.argv[1] if len(sys.argv) > 1 else 'uint8'
+    header = build_store(dtype)
+    array_path, _ = store_paths(dtype)
+
+    float_bytes = header['shape'][0] * header['shape'][1] * 8
+    print(f"Occupancy store saved: {header['shape'][0]} cells x {header['shape'][1]} species as {dtype}, "
+          f'{os.path.getsize(array_path) / 1024:.0f} KB ({float_bytes / 1024:.0f} KB as float64)')
+    print(f'.../{array_path}')
@@ -0,0 +1,250 @@
+"""BirdTrails/pipeline.py updates the saved indexes and maps when only part of the data changes
+
+DOC publishes updated track data far more often than the occupancy grid changes, and a new
+Trails.shp usually only adds, removes or edits a few tracks. The indexes built from the data
+were rebuilt completely whenever any of their source files was newer, and every map was drawn
+again. This script records a content hash of every trail and grid cell (data/cache/pipeline.json)
+and, when the data changes, compares the new hashes with the recorded ones to find:
+
+    trails     the trails with a new or changed geometry (a trail that only moved to another
+               row of the file is matched by its geometry and keeps its results)
+    cells      the grid cells with a changed geometry, and those with changed occupancy values
+    species    the species with a changed column of occupancy values
+
+and recomputes only what depends on them, leaving every other saved entry as it was:
+
+    incidence.npz       the rows of the changed trails and the columns of the changed cells
+                        (see incidence.py)
+    occupancy.npz       the trails that changed or cross a changed cell (see occupancy.py)
+    species_index.npz   the cell ranking of the changed species, and the trail ranking of every
+                        species if the incidence changed, otherwise only of the changed species
+                        (see species_index.py)
+    maps                maps in the result cache are keyed by a hash of the trails, grid cells
+                        and species they are drawn from (see map_version), so only the maps of
+                        changed trails and species are drawn again
+
+A change in the number of grid cells or in the species columns is not tracked per feature, and
+the indexes are then rebuilt completely, as are indexes that were already out of date.
+
+analysis.load_data() runs the update before loading the indexes. Run this script directly to
+update them and see what changed.
+
+"""
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+import shapely
+import datacache
+import resultcache
+from incidence import INCIDENCE_PATH, update_incidence, cells_for_trails
+from occupancy import ATTRIBUTES_PATH, OCCUPANCY_PATH, WEIGHTINGS, update_occupancy, save_occupancy
+from species_index import SPECIES_INDEX_PATH, update_species_index, save_species_index, top_trails
+from trailsearch import find_trail
+
+
+# location of the recorded hashes
+MANIFEST_PATH = os.path.join(datacache.CACHE_DIR, 'pipeline.json')
+
+# the datasets drawn on every map besides the trails and grid (see basemap.py)
+MAP_LAYERS = ('outline', 'lakes', 'rivers')
+
+# the hash lists of the manifest, kept as uint64 arrays once loaded
+HASH_LISTS = ('trail_geometry', 'trail_features', 'cell_geometry', 'cell_values')
+
+
+# one hash (hex) of strings and arrays
+def combined(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode() if isinstance(part, str) else np.ascontiguousarray(part).tobytes())
+    return digest.hexdigest()
+
+
+# a 64 bit hash of each geometry
+def geometry_hashes(frame):
+    return pd.util.hash_pandas_object(pd.Series(shapely.to_wkb(np.asarray(frame.geometry))), index=False).to_numpy()
+
+
+# a 64 bit hash of each row, attributes and geometry
+def feature_hashes(frame):
+    rows = frame.drop(columns='geometry').assign(geometry=shapely.to_wkb(np.asarray(frame.geometry)))
+    return pd.util.hash_pandas_object(rows, index=False).to_numpy()
+
+
+# the size and modification time of the trail and grid files and the species attributes, to
+# tell without reading them that they have not changed
+def source_stamps():
+    paths = [ATTRIBUTES_PATH]
+    for name in ('trails', 'grid'):
+        paths += sorted(glob.glob(f"{os.path.splitext(datacache.DATASETS[name])[0]}.*"))
+    return {path: f'{os.stat(path).st_size}:{os.stat(path).st_mtime_ns}' for path in paths}
+
+
+# the hashes of every trail and grid cell, and of each species column
+def build_manifest(trails, grid, codes):
+    return {
+        'stamps': source_stamps(),
+        'codes': list(codes),
+        'trail_geometry': geometry_hashes(trails),
+        'trail_features': feature_hashes(trails),
+        'cell_geometry': geometry_hashes(grid),
+        'cell_values': pd.util.hash_pandas_object(grid[list(codes)], index=False).to_numpy(),
+        'species': {code: combined(grid[code].to_numpy(dtype=np.float64)) for code in codes},
+    }
+
+
+# save the hashes as JSON, written to a temporary file first as other processes may be reading it
+def save_manifest(manifest, path=MANIFEST_PATH):
+    saved = {key: value.tolist() if key in HASH_LISTS else value for key, value in manifest.items()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp{os.getpid()}', 'w') as f:
+        json.dump(saved, f)
+    os.replace(f'{path}.tmp{os.getpid()}', path)
+
+
+# load the recorded hashes, or None if there are none
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    for key in HASH_LISTS:
+        manifest[key] = np.array(manifest[key], dtype=np.uint64)
+    return manifest
+
+
+# the recorded row of each new row with the same hash: the same row if it is unchanged, else the
+# first recorded row with that hash not matched yet, or -1 for new and changed rows
+def match_rows(old, new):
+    rows = np.full(len(new), -1, dtype=np.int64)
+    n = min(len(old), len(new))
+    same = np.flatnonzero(old[:n] == new[:n])
+    rows[same] = same
+
+    unused = np.ones(len(old), dtype=bool)
+    unused[same] = False
+    free = {}
+    for row in np.flatnonzero(unused):
+        free.setdefault(old[row], []).append(row)
+    for row in np.flatnonzero(rows < 0):
+        if free.get(new[row]):
+            rows[row] = free[new[row]].pop(0)
+    return rows
+
+
+# check a saved file was built from the recorded data, i.e. is newer than the recorded source files
+def built_from(path, manifest):
+    built = max(int(stamp.split(':')[1]) for stamp in manifest['stamps'].values()) / 1e9
+    return os.path.exists(path) and os.path.getmtime(path) > built
+
+
+# the incidence index with its rows moved to the new trail rows. Rows of new trails are empty
+def move_rows(incidence, old_rows, n_cols):
+    kept = np.flatnonzero(old_rows >= 0)
+    moved = sparse.coo_matrix(incidence[old_rows[kept]])
+    return sparse.csr_matrix((moved.data, (kept[moved.row], moved.col)), shape=(len(old_rows), n_cols))
+
+
+# bring the incidence index, the occupancy matrix and the species index up to date with the trail
+# and grid data, recomputing only what changed since the recorded hashes. Returns the new hashes
+# and what changed: {'trails', 'cells', 'values', 'species'}, or None when it could not be told
+# (no recorded hashes, or a different grid), in which case the indexes are rebuilt when loaded
+def update_caches(trails, grid, codes, path=MANIFEST_PATH):
+    old = load_manifest(path)
+    if old is not None and old['stamps'] == source_stamps() and old['codes'] == list(codes) and len(old['trail_geometry']) == len(trails):
+        return old, {'trails': [], 'cells': [], 'values': [], 'species': []}
+
+    new = build_manifest(trails, grid, codes)
+    if old is None or old['codes'] != new['codes'] or len(old['cell_geometry']) != len(grid):
+        save_manifest(new, path)
+        return new, None
+
+    old_rows = match_rows(old['trail_geometry'], new['trail_geometry'])
+    changes = {
+        'trails': np.flatnonzero(old_rows < 0),
+        'cells': np.flatnonzero(old['cell_geometry'] != new['cell_geometry']),
+        'values': np.flatnonzero(old['cell_values'] != new['cell_values']),
+        'species': [code for code in codes if old['species'][code] != new['species'][code]],
+    }
+    moved = len(old_rows) != len(old['trail_geometry']) or np.any(old_rows != np.arange(len(old_rows)))
+    incidence_changed = bool(moved or len(changes['trails']) or len(changes['cells']))
+
+    incidence = None
+    if built_from(INCIDENCE_PATH, old):
+        before = sparse.load_npz(INCIDENCE_PATH).tocsr()
+        if before.shape == (len(old['trail_geometry']), len(grid)):
+            before = move_rows(before, old_rows, len(grid)) if moved else before
+            incidence = update_incidence(before, trails, grid, changes['trails'], changes['cells']) if incidence_changed else before
+            sparse.save_npz(INCIDENCE_PATH, incidence)
+
+    if incidence is not None and built_from(OCCUPANCY_PATH, old):
+        with np.load(OCCUPANCY_PATH) as saved:
+            matrix, species, weighting = saved['occupancy'], saved['species'].tolist(), str(saved['weighting'])
+        if species == list(codes) and len(matrix) == len(old['trail_geometry']):
+            if moved:
+                kept = np.flatnonzero(old_rows >= 0)
+                matrix, before_matrix = np.full((len(trails), len(codes)), np.nan), matrix
+                matrix[kept] = before_matrix[old_rows[kept]]
+            # the changed trails, and the trails crossing a changed cell before or after the change
+            cells = np.union1d(changes['cells'], changes['values'])
+            crossing = np.union1d(sparse.csc_matrix(before)[:, cells].nonzero()[0], sparse.csc_matrix(incidence)[:, cells].nonzero()[0])
+            update_occupancy(matrix, WEIGHTINGS[weighting](incidence), grid, codes, np.union1d(changes['trails'], crossing))
+            save_occupancy(matrix, trails['name'], codes, weighting)
+
+    if incidence is not None and built_from(SPECIES_INDEX_PATH, old):
+        with np.load(SPECIES_INDEX_PATH) as saved:
+            index = {key: saved[key] for key in saved.files}
+        index['codes'] = index['codes'].tolist()
+        if index['codes'] == list(codes) and index['cell_order'].shape[0] == len(grid):
+            save_species_index(update_species_index(index, incidence, grid, changes['species'], incidence_changed))
+
+    save_manifest(new, path)
+    return new, changes
+
+
+# the data version of a map job (see render.job_key): a hash of the trails, grid cells and species
+# the map is drawn from, so it only changes when they do. data is from analysis.load_data().
+# None if the trail or species is not in the data
+def map_version(data, kind, key, top_grids=50):
+    features = data['features']
+    if kind == 'trail':
+        try:
+            _, trail_ids = find_trail(data['trail_names'], key)
+        except KeyError:
+            return None
+        trail_ids = np.asarray(trail_ids, dtype=np.int64)
+        cells = cells_for_trails(data['incidence'], trail_ids)
+        parts = [features['trail_features'][trail_ids], cells, features['cell_values'][cells]]
+    else:
+        if key not in data['species']:
+            return None
+        # the top trails, and the other segments of their routes (see routes.py)
+        names = data['trails']['name']
+        found = top_trails(data['species_index'], key, None, top_grids)
+        trail_ids = np.flatnonzero(names.isin(names.iloc[found]).to_numpy())
+        parts = [features['species'][key], features['trail_features'][trail_ids]]
+
+    # every map is drawn on the whole grid and the outline, lakes and rivers
+    return combined(kind, features['cell_geometry'], resultcache.dataset_hash(MAP_LAYERS), trail_ids, *parts)
+
+
+if __name__ == '__main__':
+    from occupancy import species_codes
+
+    trails = datacache.load('trails')
+    grid = datacache.load('grid')
+    codes = species_codes(grid, pd.read_csv(ATTRIBUTES_PATH))
+
+    features, changes = update_caches(trails, grid, codes)
+    if changes is None:
+        print('Hashes recorded (there were none for this grid before), out of date indexes are rebuilt when next loaded')
+    else:
+        print(f"Trails changed: {len(changes['trails'])} of {len(trails)}")
+        print(f"Grid cells changed: {len(changes['cells'])} in geometry, {len(changes['values'])} in occupancy")
+        print(f"Species changed: {', '.join(changes['species']) or 'none'}")
+    print(f'.../{MANIFEST_PATH}')
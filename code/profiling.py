@@ -0,0 +1,173 @@
+"""BirdTrails/profiling.py records the time and memory used by each stage of a BirdTrails run
+
+The main steps of the analyses (loading the data, finding the grids or trails, working out the
+occupancy, drawing a map and saving it) are marked as stages, functions decorated with @profiled
+or stage('name') blocks. These do nothing until profiling is turned on, so they can be left in
+place. Once on, each stage records:
+
+    stage       the stage name, e.g. 'analyse_species', with enclosing stages before it
+                separated by '/', e.g. 'render_job/save_map'
+    seconds     the wall clock time of the stage
+    peak_mb     the most memory (MB) allocated by Python during the stage, above what was
+                allocated when it started (from tracemalloc)
+
+The records are written to a trace file, a .csv (rows are appended, so one file can collect many
+runs) or a .json list. With cprofile=True each stage is also run under cProfile, and the profile
+of the slowest stage is saved beside the trace as a .prof file, which can be read with pstats or
+drawn as a flame graph with tools such as snakeviz.
+
+by_trail.py, by_bird.py, batch.py and service.py turn profiling on with '--profile trace.csv'.
+Maps drawn by worker processes (batch.py --jobs, service.py) are not included, use --jobs 1 to
+include them.
+
+"""
+
+import os
+import csv
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from functools import wraps
+from contextlib import contextmanager
+
+
+# profiling settings, the records not yet written and the slowest profiled stage
+_enabled = False
+_cprofile = False
+_records = []
+_slowest = None
+_lock = threading.Lock()
+_local = threading.local() # the stages entered by each thread
+
+
+# turn profiling on. memory=False skips tracemalloc, which slows Python down while it runs
+def enable(memory=True, cprofile=False):
+    global _enabled, _cprofile
+    _enabled, _cprofile = True, cprofile
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+# time a stage of the run (and measure its peak memory) when profiling is on
+@contextmanager
+def stage(name):
+    if not _enabled:
+        yield
+        return
+
+    global _slowest
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    # memory use and peak at the start, the peak is then reset so the stage's own peak can be read
+    tracing = tracemalloc.is_tracing()
+    current = 0
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+    entry = {'name': '/'.join([item['name'] for item in stack] + [name]), 'peak': current}
+    stack.append(entry)
+
+    profiler = cProfile.Profile() if _cprofile and not any('profiler' in item for item in stack[:-1]) else None
+    if profiler:
+        try:
+            profiler.enable()
+            entry['profiler'] = profiler
+        except ValueError:
+            profiler = None # another thread is being profiled
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+        stack.pop()
+
+        record = {'stage': entry['name'], 'seconds': round(seconds, 6), 'peak_mb': None}
+        if tracing:
+            peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = round((peak - current) / 1024 ** 2, 3)
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak) # so the enclosing stage sees this peak
+
+        with _lock:
+            record['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            _records.append(record)
+            if profiler and (_slowest is None or seconds > _slowest[1]):
+                _slowest = (entry['name'], seconds, profiler)
+
+
+# run every call of a function as a stage named after the function
+def profiled(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# turn profiling on from command line arguments: '--profile <trace file>', plus '--cprofile'
+# to also save the cProfile of the slowest stage. Returns the trace file, or None if not profiling
+def from_argv(argv):
+    if '--profile' not in argv or argv.index('--profile') + 1 >= len(argv):
+        return None
+    enable(cprofile='--cprofile' in argv)
+    return argv[argv.index('--profile') + 1]
+
+
+# the records not yet written, as a list of dicts
+def records():
+    with _lock:
+        return list(_records)
+
+
+# write the records to a .csv (appended) or .json trace file, and the profile of the slowest
+# stage to <trace>.prof if cProfile was on. The written records are cleared, so this can be
+# called again, e.g. after every request of a service
+def write_trace(path):
+    global _slowest
+    with _lock:
+        written, _records[:] = list(_records), []
+        slowest, _slowest = _slowest, None
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if path.endswith('.json'):
+        trace = []
+        if os.path.exists(path):
+            with open(path) as f:
+                trace = json.load(f)
+        with open(path, 'w') as f:
+            json.dump(trace + written, f, indent=1)
+    else:
+        new = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['time', 'stage', 'seconds', 'peak_mb'])
+            if new:
+                writer.writeheader()
+            writer.writerows(written)
+
+    if slowest is not None:
+        slowest[2].dump_stats(f'{os.path.splitext(path)[0]}.prof')
+    return written
+
+
+# print a summary of records: the total time and largest peak memory of each stage
+def summary(written):
+    totals = {}
+    for record in written:
+        total = totals.setdefault(record['stage'], {'runs': 0, 'seconds': 0, 'peak_mb': None})
+        total['runs'] += 1
+        total['seconds'] += record['seconds']
+        if record['peak_mb'] is not None:
+            total['peak_mb'] = max(total['peak_mb'] or 0, record['peak_mb'])
+    print('\nStage                                     runs   seconds   peak MB')
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]['seconds']):
+        peak = '' if total['peak_mb'] is None else f"{total['peak_mb']:9.1f}"
+        print(f"{name:40} {total['runs']:5} {total['seconds']:9.3f} {peak}")
@@ -0,0 +1,90 @@
+"""BirdTrails/projection.py keeps copies of the datasets already projected into the map projection
+
+The BirdTrails maps use a NearsidePerspective projection centred on New Zealand, while the
+data is in UTM coordinates, so cartopy transforms every vertex of the trails and grid each
+time a map is drawn. Trails.shp alone holds about 1.8 MB of vertices.
+
+This script projects a dataset's geometry once, transforming all of its vertices in a single
+vectorised call, optionally simplifies it to the resolution of the exported maps, and saves
+the result in the data/cache folder. Maps then draw the projected geometry with the map
+projection as its CRS, so cartopy does not need to transform it again.
+
+A projected copy is rebuilt automatically when its source data (see datacache.py) changes,
+and is saved under a name that includes the map projection and the simplification
+tolerance, so changing either does not reuse old geometry.
+
+Run this script directly to project the trails and the grid.
+
+"""
+
+import os
+import hashlib
+import numpy as np
+import shapely
+import geopandas as gpd
+import cartopy.crs as ccrs
+import datacache
+
+
+# the coordinate reference system of the data, and the projection of the maps
+myCRS = ccrs.UTM(59, southern_hemisphere=True)  # a Universal Transverse Mercator reference system to transform our data, set over NZ
+DISPLAY_CRS = ccrs.NearsidePerspective(satellite_height=10000000.0, central_longitude=-174.88, central_latitude=-40.9)
+
+
+# default simplification tolerance in map units (m). The exported maps are 10 inches across at
+# 300 dpi and show about 1,600 km, so one pixel is about 500 m and 100 m of simplification is not visible
+TOLERANCE = 100
+
+
+# a short key for the map projection and tolerance, used in the file names of the projected copies
+def projection_key(tolerance=TOLERANCE):
+    return hashlib.md5(f'{DISPLAY_CRS.proj4_init} {tolerance}'.encode()).hexdigest()[:8]
+
+
+# the cached file for a projected dataset
+def projected_path(name, tolerance=TOLERANCE):
+    return os.path.join(datacache.CACHE_DIR, f'projected_{name}_{projection_key(tolerance)}.parquet')
+
+
+# project geometries from the data's CRS into the map projection. Shapely hands every vertex
+# of every geometry to the transform in one array, so this is a single vectorised call.
+# geometries are then simplified to the given tolerance (m), unless it is None or 0
+def project(geoms, tolerance=TOLERANCE):
+    def to_display(coords):
+        return DISPLAY_CRS.transform_points(myCRS, coords[:, 0], coords[:, 1])[:, :2]
+
+    projected = shapely.transform(np.asarray(geoms), to_display)
+    if tolerance:
+        projected = shapely.simplify(projected, tolerance, preserve_topology=True)
+    return projected
+
+
+# check the projected copy exists and is newer than its source data
+def is_current(name, tolerance=TOLERANCE):
+    path = projected_path(name, tolerance)
+    return os.path.exists(path) and os.path.getmtime(path) > datacache.source_mtime(name)
+
+
+# project a dataset and save it. The rows stay in the same order as the source data. Written to a
+# temporary file of this process first, as several map workers can build the same layer at once
+def build(name, tolerance=TOLERANCE):
+    geoms = datacache.load(name, columns=['geometry'])['geometry']
+    projected = gpd.GeoDataFrame(geometry=project(geoms, tolerance))
+    path = projected_path(name, tolerance)
+    os.makedirs(datacache.CACHE_DIR, exist_ok=True)
+    projected.to_parquet(f'{path}.tmp{os.getpid()}', index=False)
+    os.replace(f'{path}.tmp{os.getpid()}', path)
+    return projected
+
+
+# load a projected dataset (as a GeoSeries in DISPLAY_CRS coordinates), projecting it first if needed
+def load_projected(name, tolerance=TOLERANCE):
+    if not is_current(name, tolerance):
+        return build(name, tolerance)['geometry']
+    return gpd.read_parquet(projected_path(name, tolerance))['geometry']
+
+
+if __name__ == '__main__':
+    for name in ('trails', 'grid'):
+        build(name)
+        print(f'{name} -> .../{projected_path(name)}')
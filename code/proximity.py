@@ -0,0 +1,110 @@
+"""BirdTrails/proximity.py finds the bird occupancy near a trail, not only in the grids it crosses
+
+by_trail.py only uses the grid cells a trail passes through, so a trail running along the edge of
+a cell misses the cell next to it, and there is no way to ask for the birds within 2 km of a trail.
+This script finds the cells within a distance of trails with an R-tree of the grid cell centroids:
+a cell square is within a distance of a trail only if its centroid is within that distance plus
+half the cell diagonal, so one bulk query of the centroids at the largest distance gives every
+candidate cell of every trail. The exact distance from each trail to each candidate cell square
+is then measured in one vectorised call (0 for the cells the trail passes through), and each
+distance asked for is a filter on those distances. No trail is buffered, and the grid is only
+searched once however many trails and distances are asked for.
+
+The occupancy near a trail is the mean of the cells within the distance, either all counted the
+same (a buffer) or weighted by their distance from the trail (distance decay, see DECAYS):
+
+    near_occupancy(index, grid, codes, geoms, radii_km=(0, 2, 5), decay='gaussian')
+
+gives a geoms x radii x species array for many trails and distances in one call.
+
+Run this script with a trail name and distances in km to see the birds near a trail:
+
+    python proximity.py "Milford Track" 2 5
+
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+import shapely
+import datacache
+
+
+# the weight of a cell at distance d (m) from the trail, for a search distance r (m). 'none' weights
+# every cell within r the same, 'linear' falls from 1 at the trail to 0 at r, and 'gaussian' falls
+# with a standard deviation of r/2
+DECAYS = {
+    'none': lambda d, r: np.ones_like(d),
+    'linear': lambda d, r: 1 - d / r if r > 0 else np.ones_like(d),
+    'gaussian': lambda d, r: np.exp(-0.5 * (2 * d / r) ** 2) if r > 0 else np.ones_like(d),
+}
+
+
+# the R-tree of the grid cell centroids, with the cells and the largest half diagonal of a cell
+def cell_index(grid):
+    cells = np.asarray(grid.geometry)
+    xmin, ymin, xmax, ymax = shapely.bounds(cells).T
+    return {
+        'tree': shapely.STRtree(shapely.centroid(cells)),
+        'cells': cells,
+        'reach': float(np.hypot(xmax - xmin, ymax - ymin).max() / 2),
+    }
+
+
+# every cell within max_distance (m) of each geometry, as (geometry position, cell position,
+# distance (m) from the geometry to the cell square), ordered by geometry and cell
+def cell_distances(index, geoms, max_distance):
+    geoms = np.asarray(geoms)
+    geom_idx, cell_idx = index['tree'].query(geoms, predicate='dwithin', distance=max_distance + index['reach'])
+    distance = shapely.distance(geoms[geom_idx], index['cells'][cell_idx])
+    near = np.flatnonzero(distance <= max_distance)
+    near = near[np.lexsort((cell_idx[near], geom_idx[near]))]
+    return geom_idx[near], cell_idx[near], distance[near]
+
+
+# the cell positions within radius_km of each geometry, as a list of arrays
+def cells_within(index, geoms, radius_km):
+    geom_idx, cell_idx, _ = cell_distances(index, geoms, radius_km * 1000)
+    return np.split(cell_idx, np.searchsorted(geom_idx, np.arange(1, len(geoms))))
+
+
+# the mean occupancy of the cells within each distance of each geometry, weighted by decay, as a
+# geoms x radii x species array. Geometries with no cells within a distance are NaN
+def near_occupancy(index, grid, codes, geoms, radii_km=(2,), decay='none'):
+    weigh = DECAYS[decay]
+    values = grid[codes].to_numpy(dtype=np.float64)
+    geom_idx, cell_idx, distance = cell_distances(index, geoms, max(radii_km) * 1000)
+
+    result = np.full((len(geoms), len(radii_km), len(codes)), np.nan)
+    for k, radius in enumerate(radii_km):
+        within = distance <= radius * 1000
+        weights = sparse.csr_matrix((weigh(distance[within], radius * 1000), (geom_idx[within], cell_idx[within])), shape=(len(geoms), len(grid)))
+        totals = np.asarray(weights.sum(axis=1)).ravel()
+        found = totals > 0
+        result[found, k] = (weights @ values)[found] / totals[found, None]
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import pandas as pd
+    from occupancy import ATTRIBUTES_PATH, species_codes
+
+    if len(sys.argv) < 2:
+        sys.exit('Give a trail name and distances in km, e.g. python proximity.py "Milford Track" 2 5')
+    radii_km = [float(radius) for radius in sys.argv[2:]] or [2]
+
+    trails = datacache.load('trails', columns=['name'])
+    grid = datacache.load('grid')
+    bird_details = pd.read_csv(ATTRIBUTES_PATH)
+    codes = species_codes(grid, bird_details)
+
+    selected = trails[trails['name'] == sys.argv[1]]
+    if selected.empty:
+        sys.exit(f"The trail '{sys.argv[1]}' does not exist in the geodatabase")
+    trail = shapely.union_all(np.asarray(selected.geometry))
+
+    occupancy = near_occupancy(cell_index(grid), grid, codes, [trail], [0] + radii_km, decay='gaussian')[0] * 100
+    table = pd.DataFrame(occupancy.T, index=codes, columns=[f'{radius:g} km' for radius in [0] + radii_km]).round(2)
+    table = table.rename(index=dict(zip(bird_details['Code'], bird_details['Common_name'])))
+    print(f'\nBird occupancy near {sys.argv[1]} (%, distance weighted)')
+    print(table.sort_values(table.columns[-1], ascending=False).head(15).to_string())
@@ -0,0 +1,328 @@
+"""BirdTrails/render.py draws the BirdTrails maps, and renders many of them in parallel
+
+This script holds the map drawing steps of by_trail.py (a trail overview map) and by_bird.py
+(a species occupancy map) as functions, so the same maps can be drawn by the interactive
+tools, by batch.py and by other scripts.
+
+The static layers (NZ outline, lakes, rivers and the grid) and the trails are drawn from copies
+already projected into the map projection (see basemap.py and projection.py), so cartopy does
+not transform any vertices when a map is drawn.
+
+Saving a 300 dpi map is slow and runs on one core, so render_maps() spreads many map jobs
+across a pool of worker processes. Each worker loads the datasets and the base map layers
+(NZ outline, lakes, rivers and the grid) once when it starts, then draws every map it is
+given from memory.
+
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import shapely
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import Normalize
+from cartopy.feature import ShapelyFeature
+import datacache
+import resultcache
+from profiling import profiled
+from analysis import load_data, analyse_trail, analyse_species, result_tables, cache_key, cached_files
+from basemap import load_basemap
+from projection import myCRS, DISPLAY_CRS, load_projected
+
+
+# range of 15 colours compatable with the grid's colormap to identify each trail on a species map
+trailcolours = ['Red', 'Crimson', 'Maroon', 'Tomato', 'Coral', 'Gold', 'Yellow', 'LemonChiffon', 'LimeGreen', 'Green', 'OliveDrab', 'Chartreuse', 'MediumSeaGreen', 'ForestGreen', 'DarkGreen']
+
+
+# colourmap of the species maps, and its 256 colours as a lookup table shared by every species
+choropleth_cmap = matplotlib.colormaps['BuPu']
+choropleth_lut = choropleth_cmap(np.arange(choropleth_cmap.N))
+
+
+# base map layers loaded by load_base, kept for the life of the process
+_base = None
+
+
+# load the datasets, the projected map decoration layers (country outline, lakes, rivers, grid),
+# the projected trails and the map extent, once per process
+@profiled
+def load_base():
+    global _base
+    if _base is None:
+        _base = dict(load_data())
+        _base['basemap'] = load_basemap()
+        _base['trails_display'] = load_projected('trails')
+        _base['routes_display'] = route_geometries(_base['routes'], _base['trails_display'])
+        _base['bounds'] = datacache.load('outline', columns=['geometry']).total_bounds
+        _base['grid_polygons'] = polygon_vertices(_base['basemap']['grid'])
+    return _base
+
+
+# the geometry of each route (see routes.py), merged from its projected trail segments
+def route_geometries(routes, segments):
+    geoms = np.asarray(segments)
+    merged = [geoms[ids[0]] if len(ids) == 1 else shapely.union_all(geoms[ids]) for ids in routes['segments']]
+    return pd.Series(merged, index=routes.index)
+
+
+# the outline vertices of each polygon, for drawing as one PolyCollection. Polygons with the
+# same number of vertices (as the grid squares are) are returned as one cells x vertices x 2 array
+def polygon_vertices(geoms):
+    coords, index = shapely.get_coordinates(shapely.get_exterior_ring(np.asarray(geoms)), return_index=True)
+    counts = np.bincount(index, minlength=len(geoms))
+    if len(counts) and (counts == counts[0]).all():
+        return coords.reshape(len(geoms), counts[0], 2)
+    return np.split(coords, np.cumsum(counts)[:-1])
+
+
+# the colours of a column of values, from the shared lookup table. Values are scaled by norm
+# and looked up in one go, as the colourmap does for one value at a time
+def choropleth_colours(values, norm):
+    index = np.asarray(norm(values), dtype=float) * len(choropleth_lut)
+    colours = choropleth_lut[np.clip(np.nan_to_num(index), 0, len(choropleth_lut) - 1).astype(int)]
+    colours[np.isnan(index)] = 0 # cells without data are left clear
+    return colours
+
+
+# generate matplotlib handles to create a legend of the features we put in our map.
+def generate_handles(labels, colors, edge='k', alpha=1):
+    lc = len(colors)  # get the length of the color list
+    handles = []
+    for i in range(len(labels)):
+        handles.append(mpatches.Rectangle((0, 0), 1, 1, facecolor=colors[i % lc], edgecolor=edge, alpha=alpha))
+    return handles
+
+
+# create a scale bar of length 200km
+# adapted from iamdonovan's adaptation of this question: https://stackoverflow.com/q/32333870
+# answered by SO user Siyh: https://stackoverflow.com/a/35705477
+def scale_bar(ax, location=(0.92, 0.95)):
+    x0, x1, y0, y1 = ax.get_extent()
+    sbx = x0 + (x1 - x0) * location[0]
+    sby = y0 + (y1 - y0) * location[1]
+
+    ax.plot([sbx, sbx - 200000], [sby, sby], color='k', linewidth=9, transform=ax.projection)
+    ax.plot([sbx, sbx - 100000], [sby, sby], color='k', linewidth=6, transform=ax.projection)
+    ax.plot([sbx-100000, sbx - 200000], [sby, sby], color='w', linewidth=6, transform=ax.projection)
+
+    ax.text(sbx, sby-42000, '200 km', transform=ax.projection, fontsize=6)
+    ax.text(sbx-102500, sby-42000, '100 km', transform=ax.projection, fontsize=6)
+    ax.text(sbx-204500, sby-42000, '0 km', transform=ax.projection, fontsize=6)
+
+
+# create a figure and map axes, with the country outline (and optionally lakes and rivers) drawn
+# and the map zoomed to New Zealand
+def base_map(base, land='lightgreen', water=True):
+    fig = plt.figure(figsize=(10, 10))  # create a figure of size 10x10 (representing the page size in inches)
+    ax = plt.axes(projection=DISPLAY_CRS)  # create an axes object in the figure, where we can actually plot our data.
+
+    # NZ outline added using cartopys ShapelyFeature, from the layers already in the map projection
+    layers = base['basemap']
+    ax.add_feature(ShapelyFeature(layers['outline'], DISPLAY_CRS, edgecolor='k', linewidth=0.3, facecolor=land))
+    if water:
+        ax.add_feature(ShapelyFeature(layers['lakes'], DISPLAY_CRS, edgecolor='paleturquoise', linewidth=0, facecolor='paleturquoise'))
+        ax.add_feature(ShapelyFeature(layers['rivers'], DISPLAY_CRS, edgecolor='paleturquoise', linewidth=0.3, facecolor='none'))
+
+    # using the boundary of the shapefile features, zoom the map to our area of interest
+    xmin, ymin, xmax, ymax = base['bounds']
+    ax.set_extent([xmin-5000, xmax+5000, ymin-5000, ymax+5000], crs=myCRS) # because total_bounds
+    # gives output as xmin, ymin, xmax, ymax,
+    # but set_extent takes xmin, xmax, ymin, ymax, we re-order the coordinates here.
+
+    return fig, ax
+
+
+# draw the overview map for a trail result from analysis.analyse_trail
+@profiled
+def trail_map(result, base=None):
+    base = base or load_base()
+    grid = base['basemap']['grid'] # the grid geometry, already in the map projection
+    fig, ax = base_map(base)
+
+    grid_feat = ShapelyFeature(grid,  # first argument is the geometry
+     DISPLAY_CRS,  # second argument is the CRS
+     facecolor='none',  # no face colour set
+     linewidth=0.2,  # set the outline width
+     alpha=0.75, # set the alpha (transparency)
+     edgecolor='gray')
+
+    intersected_grids_geometry = ShapelyFeature(grid.iloc[result['grids']],  # first argument is the geometry
+     DISPLAY_CRS,  # second argument is the CRS
+     edgecolor='k',  # set the edgecolor
+     facecolor='none', # do not fill the grids
+     linewidth=0.5)  # set the linewidth
+
+    selected_feat = ShapelyFeature(base['trails_display'].loc[result['trail'].index],  # first argument is the geometry, already in the map projection
+     DISPLAY_CRS,  # second argument is the CRS
+     edgecolor='red',  # set the edgecolor
+     facecolor='none',  # hopefully stops the multi-line being filled in
+     linewidth=1)  # set the linewidth
+
+    ax.add_feature(grid_feat)  # add the collection of features to the map
+    ax.add_feature(intersected_grids_geometry)
+    ax.add_feature(selected_feat)
+
+    # create a table to display on the map plot, showing the top 15 species along with their average occupancy
+    toplist = result['toplist']
+    table_data = [[str(toplist.tolist()[i]) + '%', str(toplist.index[i])] for i in range(len(toplist.tolist()))]
+    table = ax.table(cellText=table_data, loc='upper left', cellLoc='left', colLabels=['Occupancy', 'Species'], edges='open')
+    table.auto_set_font_size(False)
+    table.set_fontsize(8)
+    table.scale(0.20, 1.5)
+
+    # add the title to the map including the route name, and the scale bar
+    ax.set_title(f"{result['name']} bird occupancy")
+    scale_bar(ax)
+
+    # format a legend for the grid and trails using proxy shapes
+    intersect_true = mpatches.Rectangle((0, 0), 1, 1, facecolor="k")
+    intersect_false = mpatches.Rectangle((0, 0), 1, 1, facecolor="gray")
+    labels = ['Grid square intersects \nwalking trail',
+       'Grid square does not \nintersect walking trail']
+    ax.legend([intersect_true, intersect_false], labels,
+       loc='lower right', bbox_to_anchor=(1, 0), fancybox=True)
+
+    return fig
+
+
+# draw the species map for a species result from analysis.analyse_species
+@profiled
+def species_map(result, base=None):
+    base = base or load_base()
+    grid, code = base['grid'], result['code']
+    fig, ax = base_map(base, land='white', water=False)
+
+    # normalise the bird occupancy data between its min and max value, and colour every grid in one go
+    values = grid[code].to_numpy()
+    norm = Normalize(vmin=np.nanmin(values), vmax=np.nanmax(values))
+
+    # the chloropleth grid as a single collection of the grid squares, already in the map projection
+    grid_cells = PolyCollection(base['grid_polygons'],
+      facecolors=choropleth_colours(values, norm),
+      edgecolors='k',
+      linewidths=0.2,
+      transform=ax.transData,
+      zorder=1.5) # drawn at the same level as the map features
+
+    # the colourmap legend for the chloropleth
+    fig.colorbar(ScalarMappable(norm=norm, cmap=choropleth_cmap), ax=ax)
+
+    # highlight the trails, each route in its own colour
+    toplist = result['toplist']
+    intersected_trails_geometry = ShapelyFeature(base['routes_display'].loc[toplist.index],  # first argument is the geometry, already in the map projection
+      DISPLAY_CRS,  # second argument is the CRS
+      edgecolor=trailcolours,  # set the edgecolor to be defined
+      facecolor='none',  # hopefully stops the multi-line being filled in
+      linewidth=3)  # set the linewidth
+
+    # add the species specific chloropleth grid and intersected trails to map
+    ax.add_collection(grid_cells, autolim=False)
+    ax.add_feature(intersected_trails_geometry)
+
+    # Create the table. colour text in the table, same order as the trail geometry colours
+    if len(toplist):
+        table_data = [[str(toplist['SHAPE_Leng'].iloc[i]) + 'km', str(toplist['name'].iloc[i])] for i in range(len(toplist))]
+        table = ax.table(cellText=table_data,
+                         loc='upper left',
+                         cellColours=[[colour, 'White'] for colour in trailcolours[:len(toplist)]],
+                         cellLoc='left',
+                         colLabels=['Length', 'Trail name'])
+        table.auto_set_font_size(False)
+        table.set_fontsize(7) # smaller font, as trail names can be quite long
+        table.scale(0.15, 1.55)  # Adjust the table size if needed
+        for key, cell in table.get_celld().items():
+            cell.set_linewidth(0)
+
+    # add the title to the map, and the scale bar
+    ax.set_title(f"{result['name']} occupancy with trails")
+    scale_bar(ax)
+
+    return fig
+
+
+# export a map as a .png and free its memory
+@profiled
+def save_map(fig, path):
+    fig.savefig(path, bbox_inches='tight', dpi=300)
+    plt.close(fig)
+
+
+# set up a worker process: draw without a screen and load the base layers once
+def init_worker():
+    matplotlib.use('Agg')
+    load_base()
+
+
+# the result cache key of a map job (see analysis.cache_key)
+def job_key(job, top_grids=50):
+    kind, key = job
+    return cache_key(kind, key, load_data(), top_grids)
+
+
+# the cached .png of a map job, or None if it has not been drawn for the current data
+def cached_map(job, top_grids=50):
+    kind, key = job
+    cached = cached_files(kind, key, load_data(), top_grids)
+    if cached is None:
+        return None
+    return next((path for name, path in cached.items() if name.endswith('.png')), None)
+
+
+# run one map job, ('trail', name) or ('species', code). Returns (job, path of the .png),
+# with a path of None if the trail or species is not in the data. result is the job's result
+# from analysis.py if it was already worked out, so it is not analysed again.
+# a map already drawn for the same query and data is copied from the result cache instead of redrawn
+@profiled
+def render_job(job, out_dir='user', top_grids=50, result=None):
+    kind, key = job
+    cached = cached_map(job, top_grids)
+    if cached is not None:
+        path = os.path.join(out_dir, os.path.basename(cached))
+        shutil.copyfile(cached, path)
+        return job, path
+
+    base = load_base()
+    try:
+        if kind == 'trail':
+            result = result or analyse_trail(key, base)
+            fig, path = trail_map(result, base), os.path.join(out_dir, f"{result['name']} overview.png")
+        else:
+            result = result or analyse_species(key, base, top_grids=top_grids)
+            fig, path = species_map(result, base), os.path.join(out_dir, f"{result['name']} species map.png")
+    except KeyError:
+        return job, None
+    save_map(fig, path)
+
+    # keep the map and its .csv tables for the next time the same query is asked
+    resultcache.put(job_key(job, top_grids), {os.path.basename(path): path, **result_tables(kind, result)})
+    return job, path
+
+
+# run a (job, result) pair, for the worker pool (see render_maps)
+def render_pair(pair, out_dir='user', top_grids=50):
+    job, result = pair
+    return render_job(job, out_dir, top_grids, result)
+
+
+# render many map jobs across n_jobs worker processes (default: one per core), yielding
+# (job, path) as each map is saved. n_jobs=1 renders in this process. results are the results
+# of the jobs from analysis.py, in the same order, if they were already worked out
+def render_maps(jobs, n_jobs=None, out_dir='user', top_grids=50, results=None):
+    run = partial(render_pair, out_dir=out_dir, top_grids=top_grids)
+    pairs = zip(jobs, results or repeat(None))
+    if n_jobs == 1:
+        init_worker()
+        yield from map(run, pairs)
+        return
+
+    load_base() # build any missing caches once here, rather than in every worker at the same time
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker) as pool:
+        yield from pool.map(run, pairs)
@@ -0,0 +1,151 @@
+"""BirdTrails/resultcache.py keeps the results of earlier queries so they are not redrawn
+
+Asking for the same trail or species twice used to redo the analysis and redraw the 300 dpi
+map both times. This script stores the results of a query (the map .png, the occupancy .csv
+and the ranked top list) in the data/cache/results folder under a key made from:
+
+    the kind of query and what was asked for    e.g. ('trail', 'Milford Track')
+    the query parameters                        e.g. {'top_grids': 50}
+    the version of the data it was worked out from
+
+The version is given by the caller. The maps and tables of trails and species use
+pipeline.map_version, a hash of only the trails, grid cells and species they are drawn from (see
+analysis.cache_key), so a result is only redrawn when its own data changes. Without a version,
+a hash of the contents of all the source data is used (dataset_hash), so a result is never
+reused after any of the data changes.
+
+The cache is limited in size. Every time a result is used it is marked as recently used, and
+when the cache grows past its limit the results that have gone longest without being used are
+deleted first (least recently used).
+
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import datacache
+
+
+RESULTS_DIR = os.path.join(datacache.CACHE_DIR, 'results')
+MAX_BYTES = 500 * 1024 * 1024  # the size limit of the cache (500 MB, about 400 trail and species maps)
+
+# bump this when the maps or tables are drawn differently, so old results are not reused
+RESULT_VERSION = 3
+
+# the file recording the content hash of each source file, so unchanged files are not re-read
+HASHES_PATH = os.path.join(datacache.CACHE_DIR, 'source_hashes.json')
+
+
+# dataset hashes for this process, by the datasets hashed, worked out by dataset_hash
+_dataset_hash = {}
+
+
+# the content hash of a file. Hashes are remembered by file size and modification time, so a
+# file is only read again after it has changed
+def file_hash(path, known):
+    stat = os.stat(path)
+    stamp = f'{stat.st_size}:{stat.st_mtime_ns}'
+    if known.get(path, {}).get('stamp') != stamp:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        known[path] = {'stamp': stamp, 'hash': digest.hexdigest()}
+    return known[path]['hash']
+
+
+# a hash of the contents of the source files of some datasets (default all the shapefiles),
+# and of the species attributes
+def dataset_hash(names=None):
+    names = tuple(names or datacache.DATASETS)
+    if names not in _dataset_hash:
+        known = {}
+        if os.path.exists(HASHES_PATH):
+            with open(HASHES_PATH) as f:
+                known = json.load(f)
+        before = json.dumps(known, sort_keys=True)
+
+        sources = [datacache.ATTRIBUTES_PATH]
+        for name in names:
+            stem = os.path.splitext(datacache.DATASETS[name])[0]
+            sources += sorted(p for p in (f'{stem}{ext}' for ext in ('.shp', '.dbf', '.shx', '.prj')) if os.path.exists(p))
+
+        digest = hashlib.sha256()
+        for path in sources:
+            digest.update(f'{path}={file_hash(path, known)}\n'.encode())
+        _dataset_hash[names] = digest.hexdigest()
+
+        # remember any new hashes, written to a temporary file first as other processes may be reading it
+        if json.dumps(known, sort_keys=True) != before:
+            os.makedirs(datacache.CACHE_DIR, exist_ok=True)
+            tmp = f'{HASHES_PATH}.tmp{os.getpid()}'
+            with open(tmp, 'w') as f:
+                json.dump(known, f)
+            os.replace(tmp, HASHES_PATH)
+    return _dataset_hash[names]
+
+
+# the cache key of a query: its kind, what was asked for, its parameters and the data version
+# (by default the hash of all the source data)
+def result_key(kind, query, params=None, version=None):
+    text = json.dumps([RESULT_VERSION, kind, query, params or {}, version or dataset_hash()], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# the folder holding the results of a query
+def entry_path(key):
+    return os.path.join(RESULTS_DIR, key)
+
+
+# the stored files of a query, as {file name: path}, or None if it is not in the cache.
+# the query is marked as recently used
+def get(key):
+    path = entry_path(key)
+    if not os.path.isdir(path):
+        return None
+    os.utime(path) # mark as recently used
+    return {name: os.path.join(path, name) for name in os.listdir(path)}
+
+
+# store the results of a query. files is {file name: bytes, or the path of a file to copy}.
+# returns the stored files as {file name: path}
+def put(key, files, max_bytes=MAX_BYTES):
+    path = entry_path(key)
+    tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    for name, content in files.items():
+        if isinstance(content, bytes):
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(content)
+        else:
+            shutil.copyfile(content, os.path.join(tmp, name))
+
+    # move the finished entry into place, so other processes never see half of it. If another
+    # process stored the same query first, its entry is kept
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(tmp)
+
+    evict(max_bytes)
+    return {name: os.path.join(path, name) for name in os.listdir(path)}
+
+
+# delete the least recently used results until the cache is within its size limit
+def evict(max_bytes=MAX_BYTES):
+    entries = []
+    for name in os.listdir(RESULTS_DIR):
+        path = os.path.join(RESULTS_DIR, name)
+        if os.path.isdir(path) and '.tmp' not in name:
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.path.getmtime(path), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,108 @@
+"""BirdTrails/routes.py groups the DOC trail segments into whole routes
+
+A DOC track can be stored in Trails.shp as several records (segments), each with the track's
+name. Analysed segment by segment, one track can then take several places in a species' top 15
+list, and its length is only that of one segment. This script dissolves the segments into routes
+before they are listed:
+
+    segments with the same name that touch, or come within CONNECT_DISTANCE (m) of each other,
+    are one route. Segments sharing a name but far apart (e.g. the several 'Rimu Walk's in
+    different parts of the country) stay separate routes
+
+Each route has the merged geometry of its segments, their summed length (SHAPE_Leng), the
+other details (difficulty, completion time, website, ...) of its first segment, and the list
+of its segment ids. The route table is saved in the data/cache folder and rebuilt when the
+trail data changes.
+
+Run this script directly to (re)build the route table.
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import datacache
+
+
+# location of the saved route table, and how close segments of the same name must be to join
+ROUTES_PATH = os.path.join(datacache.CACHE_DIR, 'routes.parquet')
+CONNECT_DISTANCE = 50
+
+
+# the route id of every segment: segments are joined when they have the same name and are
+# within CONNECT_DISTANCE of each other, directly or through other segments of that name
+def route_ids(trails, distance=CONNECT_DISTANCE):
+    geoms = np.asarray(trails.geometry)
+    names = trails['name'].to_numpy()
+    left, right = shapely.STRtree(geoms).query(geoms, predicate='dwithin', distance=distance)
+    same = names[left] == names[right]
+    graph = coo_matrix((np.ones(same.sum()), (left[same], right[same])), shape=(len(geoms), len(geoms)))
+    _, labels = connected_components(graph, directed=False)
+
+    # number the routes in the order of their first segment, so unsplit data keeps its trail ids
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    return order[inverse]
+
+
+# dissolve the segments into a route table, one row per route indexed by route id
+def build_routes(trails, distance=CONNECT_DISTANCE):
+    route_of = route_ids(trails, distance)
+    segments = pd.Series(np.arange(len(trails))).groupby(route_of).agg(list)
+
+    # the details of the first segment, the summed length and the merged geometry of each route
+    routes = trails.drop(columns='geometry').iloc[[ids[0] for ids in segments]].reset_index(drop=True)
+    routes['SHAPE_Leng'] = trails['SHAPE_Leng'].groupby(route_of).sum().to_numpy()
+    routes['segments'] = segments.to_numpy()
+    geoms = np.asarray(trails.geometry)
+    merged = [geoms[ids[0]] if len(ids) == 1 else shapely.line_merge(shapely.union_all(geoms[ids])) for ids in segments]
+    return gpd.GeoDataFrame(routes, geometry=merged, crs=trails.crs)
+
+
+# check the saved route table is newer than the trail data
+def routes_are_current(path=ROUTES_PATH):
+    return os.path.exists(path) and os.path.getmtime(path) > datacache.source_mtime('trails')
+
+
+# load the saved route table, building and saving it first if it is missing or out of date
+def load_routes(trails, path=ROUTES_PATH):
+    if routes_are_current(path):
+        routes = gpd.read_parquet(path)
+        if sum(len(ids) for ids in routes['segments']) == len(trails):
+            routes['segments'] = routes['segments'].apply(list)
+            return routes
+
+    routes = build_routes(trails)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    routes.to_parquet(f'{path}.tmp{os.getpid()}')
+    os.replace(f'{path}.tmp{os.getpid()}', path)
+    return routes
+
+
+# the route id of every segment, from a route table
+def segment_routes(routes):
+    route_of = np.empty(sum(len(ids) for ids in routes['segments']), dtype=np.int64)
+    for route_id, ids in zip(routes.index, routes['segments']):
+        route_of[ids] = route_id
+    return route_of
+
+
+# the distinct routes of ranked segment ids, in the order each route is first found
+def distinct_routes(route_of, trail_ids):
+    routes = route_of[np.asarray(trail_ids, dtype=np.int64)]
+    _, first = np.unique(routes, return_index=True)
+    return routes[np.sort(first)]
+
+
+if __name__ == '__main__':
+    trails = datacache.load('trails')
+    routes = build_routes(trails)
+    os.makedirs(os.path.dirname(ROUTES_PATH), exist_ok=True)
+    routes.to_parquet(ROUTES_PATH)
+
+    print(f'Route table saved: {len(trails)} segments in {len(routes)} routes')
+    print(f'.../{ROUTES_PATH}')
@@ -0,0 +1,218 @@
+"""BirdTrails/service.py is a local web service answering trail and species lookups
+
+Running by_trail.py or by_bird.py for every lookup means starting Python, importing geopandas
+and cartopy and reading every dataset each time. This script loads the trails, occupancy grid,
+species attributes and trail/grid incidence index once, keeps them in memory, and answers
+lookups over HTTP:
+
+    /trail?name=Milford Track            top species along a trail (add &format=csv for the
+                                         bird occupancy data of the grids along the trail)
+    /species?code=kea                    top trails for a species (add &format=csv for a table,
+                                         &top_grids=N to check more or fewer grids, &threshold=0.6
+                                         to only check grids with at least that occupancy)
+    /species?code=kea,kaka               trails through the top grids of every listed species
+    /near?name=Milford Track&km=2,5      top species within some distances of a trail (add
+                                         &decay=linear or gaussian to weight the grids by their
+                                         distance, &format=csv for a table, see proximity.py)
+    /map/trail?name=Milford Track        the trail overview map as a .png
+    /map/species?code=kea                the species map as a .png
+
+Maps are drawn by a pool of worker processes (see render.py), so a slow map never holds up
+the table lookups, and a map drawn before for the same query is sent straight from the
+result cache (see resultcache.py). Start the service with:
+
+    python service.py --port 8000 --jobs 2
+
+"""
+
+import json
+import math
+import argparse
+import threading
+import profiling
+from concurrent.futures import ProcessPoolExecutor
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer
+from analysis import load_data, analyse_trail, analyse_trail_near, analyse_species, analyse_species_all
+from proximity import DECAYS
+
+
+# the query parameter each path needs, a trail name or species code(s)
+REQUIRED = {'/trail': 'name', '/near': 'name', '/map/trail': 'name', '/species': 'code', '/map/species': 'code'}
+
+
+# the datasets, loaded once when the app is created, and the map worker pool (started on the first map request)
+_data = None
+_pool = None
+_pool_lock = threading.Lock()
+_jobs = None
+_out_dir = 'user'
+_profile_path = None # the trace file of each request's stages, if profiling (see profiling.py)
+
+
+# a JSON number, with NaN (no occupancy data) as null
+def number(value):
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+# top species along a trail, as JSON or the grid occupancy data as CSV
+def trail_lookup(query):
+    result = analyse_trail(query['name'], _data, cached=True) # tables of trails drawn before are read from the result cache
+    if query.get('format') == 'csv':
+        return 'text/csv', result['birdstats'].to_csv(index=False).encode('utf-8')
+
+    body = {
+        'name': result['name'],
+        'length_km': round(float(result['length_km']), 2),
+        'route_km': [round(float(km), 2) for km in result['route_km']], # one for each trail with this name
+        'grids': result['grids'],
+        'top_species': [{'species': species, 'occupancy': number(value)} for species, value in result['toplist'].items()],
+        'landuse': {name: number(float(value)) for name, value in result['landuse'].items()},
+    }
+    return 'application/json', json.dumps(body).encode('utf-8')
+
+
+# top species within some distances of a trail, as JSON or CSV
+def near_lookup(query):
+    radii_km = [float(radius) for radius in query.get('km', '2').split(',')]
+    decay = query.get('decay', 'none')
+    if decay not in DECAYS:
+        raise ValueError(f"unknown decay '{decay}', choose from: {', '.join(DECAYS)}")
+    result = analyse_trail_near(query['name'], _data, radii_km=radii_km, decay=decay)
+    if query.get('format') == 'csv':
+        return 'text/csv', result['nearby'].to_csv(index_label='Species').encode('utf-8')
+
+    body = {
+        'name': result['name'],
+        'radii_km': radii_km,
+        'decay': decay,
+        'grids': {f'{radius:g}': cells for radius, cells in result['grids'].items()},
+        'top_species': [{'species': species, 'occupancy': {column: number(value) for column, value in row.items()}}
+                        for species, row in result['nearby'].head(15).iterrows()],
+    }
+    return 'application/json', json.dumps(body).encode('utf-8')
+
+
+# top trails for a species, or for several species at once, as JSON or CSV
+def species_lookup(query):
+    codes = query['code'].split(',')
+    top_grids = int(query.get('top_grids', 50))
+    threshold = float(query['threshold']) if 'threshold' in query else None
+    if len(codes) > 1:
+        result = analyse_species_all(codes, _data, top_grids=top_grids, threshold=threshold)
+        result['code'], result['name'] = ','.join(result['codes']), ', '.join(result['names'])
+    else:
+        result = analyse_species(codes[0], _data, top_grids=top_grids, threshold=threshold)
+    ranked = _data['routes'].loc[result['route_ids']] # whole routes, in order of their best grid
+    table = ranked[['name', 'SHAPE_Leng', 'difficulty', 'completion', 'walkingAnd']].rename(columns={'SHAPE_Leng': 'length_km', 'walkingAnd': 'website'})
+    table['length_km'] = (table['length_km'] / 1000).round(1)
+
+    if query.get('format') == 'csv':
+        return 'text/csv', table.to_csv(index=False).encode('utf-8')
+
+    body = {
+        'code': result['code'],
+        'name': result['name'],
+        'top_trails': [{key: number(value) for key, value in row.items()} for row in table.to_dict(orient='records')],
+    }
+    return 'application/json', json.dumps(body, default=str).encode('utf-8')
+
+
+# draw a map in the worker pool and return the .png
+def map_lookup(kind, key, query):
+    global _pool
+    from render import init_worker, load_base, render_job, cached_map # cartopy is only imported when maps are wanted
+    top_grids = int(query.get('top_grids', 50))
+
+    # a map drawn before for the same query and data is sent straight from the result cache
+    path = cached_map((kind, key), top_grids)
+    if path is None:
+        with _pool_lock:
+            if _pool is None:
+                load_base() # build any missing map caches once here, rather than in every worker at the same time
+                _pool = ProcessPoolExecutor(max_workers=_jobs, initializer=init_worker)
+        job, path = _pool.submit(render_job, (kind, key), out_dir=_out_dir, top_grids=top_grids).result()
+    if path is None:
+        raise KeyError(key)
+    with open(path, 'rb') as f:
+        return 'image/png', f.read()
+
+
+# the WSGI application. When profiling, each request is a stage and the trace is written after it
+def app(environ, start_response):
+    if _profile_path is None:
+        return handle(environ, start_response)
+    try:
+        with profiling.stage(environ.get('PATH_INFO', '/')):
+            return handle(environ, start_response)
+    finally:
+        profiling.write_trace(_profile_path)
+
+
+# answer one request
+def handle(environ, start_response):
+    path = environ.get('PATH_INFO', '/')
+    query = {key: values[0] for key, values in parse_qs(environ.get('QUERY_STRING', '')).items()}
+
+    try:
+        # a missing parameter is a bad request, where KeyError is kept for unknown trails and species
+        if path in REQUIRED and REQUIRED[path] not in query:
+            raise ValueError(f"missing parameter '{REQUIRED[path]}'")
+        if path == '/trail':
+            content_type, body = trail_lookup(query)
+        elif path == '/species':
+            content_type, body = species_lookup(query)
+        elif path == '/near':
+            content_type, body = near_lookup(query)
+        elif path == '/map/trail':
+            content_type, body = map_lookup('trail', query['name'], query)
+        elif path == '/map/species':
+            content_type, body = map_lookup('species', query['code'], query)
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Unknown path, use /trail, /species, /near, /map/trail or /map/species']
+    except KeyError as error:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [f'Not found: {error}'.encode('utf-8')]
+    except ValueError as error:
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return [f'Bad request: {error}'.encode('utf-8')]
+
+    start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+# load the datasets and return the WSGI app. jobs is the number of map worker processes,
+# profile_path a trace file to record the time and memory of each request in
+def create_app(jobs=None, out_dir='user', profile_path=None):
+    global _data, _jobs, _out_dir, _profile_path
+    _jobs, _out_dir, _profile_path = jobs, out_dir, profile_path
+    if profile_path:
+        profiling.enable(memory=False) # tracemalloc slows every request down, so only time them
+    _data = load_data()
+    return app
+
+
+# wsgiref's server handles one request at a time, this one handles each request in its own thread
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve BirdTrails trail and species lookups over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default 8000)')
+    parser.add_argument('--jobs', type=int, default=None, help='number of processes drawing maps (default: one per core)')
+    parser.add_argument('--profile', metavar='TRACE', help='record the time of each request and its stages in a .csv trace file (see profiling.py)')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, create_app(args.jobs, profile_path=args.profile), server_class=ThreadingWSGIServer)
+    print(f'BirdTrails service running on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if _pool is not None:
+            _pool.shutdown()
@@ -0,0 +1,23 @@
+"""BirdTrails/spatial_join.py is a small spatial join engine for trails and grid cells
+
+This script wraps Shapely's STRtree, a packed R-tree built over the bounding boxes of the
+Department of Conservation trails, so that many grid cells can be tested against every
+trail in one bulk query instead of one 'intersects' scan of all trails per cell.
+
+"""
+
+import numpy as np
+import shapely
+
+
+# build a packed R-tree over the bounding boxes of a set of geometries (usually the trails)
+def build_tree(geoms):
+    return shapely.STRtree(np.asarray(geoms))
+
+
+# bulk join: test every query geometry against the tree in one call.
+# returns two arrays, the position of each query geometry and of the tree geometry it matches
+def join(tree, geoms, predicate='intersects'):
+    query_idx, tree_idx = tree.query(np.asarray(geoms), predicate=predicate)
+    return query_idx, tree_idx
+
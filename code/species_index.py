@@ -0,0 +1,168 @@
+"""BirdTrails/species_index.py builds a per-species index of grid cells and trails for by_bird.py
+
+To find the trails for a bird, by_bird.py ranks the grid cells by the bird's occupancy and
+then looks up the trails in the best cells. This script does that ranking once for every
+species and saves it, so a species query becomes a short scan from the top of a list:
+
+    cell_order    for each species, the grid cell ids from highest to lowest occupancy
+    cell_values   the occupancy of those cells, in the same order
+    trail_order   for each species, the ids of the trails that cross any grid, ordered by
+                  the rank of the best cell they pass through (ties broken by trail id)
+    trail_rank    the rank of that best cell, in the same order. As the ranks only go up,
+                  the number of trails found in the top k cells (the cumulative trail hits)
+                  is a binary search of this list for k
+
+Cells with the same occupancy are ranked by cell id. The index is built from the trail/grid
+incidence index (see incidence.py) and saved in the data/cache folder. It is rebuilt
+automatically when the trail or grid data changes.
+
+Run this script directly to (re)build the index, otherwise it is built on first use.
+
+"""
+
+import os
+import numpy as np
+import datacache
+
+
+# location of the saved index
+SPECIES_INDEX_PATH = 'data/cache/species_index.npz'
+
+
+# rank the cells of every species (column of values) at once, highest occupancy first and ties by cell id
+def rank_cells(values):
+    cell_order = np.argsort(-values, axis=0, kind='stable').astype(np.int32)
+    return cell_order, np.take_along_axis(values, cell_order, axis=0)
+
+
+# rank the trails crossing any grid for every species (column of cell_order) by their best cell
+def rank_trails(incidence, cell_order):
+    cell_rank = np.empty_like(cell_order)
+    np.put_along_axis(cell_rank, cell_order, np.arange(len(cell_order), dtype=np.int32)[:, None], axis=0)
+
+    # the best (lowest) cell rank along each trail that crosses any grid, for every species
+    counts = np.diff(incidence.indptr)
+    crossing = np.flatnonzero(counts)
+    best_rank = np.minimum.reduceat(cell_rank[incidence.indices], incidence.indptr[crossing], axis=0)
+
+    # order the trails of each species by their best rank, ties by trail id
+    order = np.argsort(best_rank, axis=0, kind='stable')
+    trail_order = crossing[order].astype(np.int32)
+    trail_rank = np.take_along_axis(best_rank, order, axis=0)
+    return trail_order, trail_rank
+
+
+# build the index for the species codes (grid columns) from the incidence index
+def build_species_index(incidence, grid, codes):
+    cell_order, cell_values = rank_cells(grid[codes].to_numpy(dtype=np.float64))
+    trail_order, trail_rank = rank_trails(incidence, cell_order)
+    return {
+        'codes': list(codes),
+        'cell_order': cell_order,
+        'cell_values': cell_values,
+        'trail_order': trail_order,
+        'trail_rank': trail_rank,
+    }
+
+
+# update an index in place after some of the data changed: the cells of the changed species are
+# ranked again, and the trails of those species, or of every species if the incidence index changed
+def update_species_index(index, incidence, grid, changed_codes, incidence_changed=False):
+    columns = [species_column(index, code) for code in changed_codes]
+    if columns:
+        index['cell_order'][:, columns], index['cell_values'][:, columns] = rank_cells(grid[list(changed_codes)].to_numpy(dtype=np.float64))
+    if incidence_changed:
+        index['trail_order'], index['trail_rank'] = rank_trails(incidence, index['cell_order'])
+    elif columns:
+        index['trail_order'][:, columns], index['trail_rank'][:, columns] = rank_trails(incidence, index['cell_order'][:, columns])
+    return index
+
+
+# save the index as a single .npz file
+def save_species_index(index, path=SPECIES_INDEX_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, codes=np.asarray(index['codes'], dtype=str), cell_order=index['cell_order'], cell_values=index['cell_values'],
+             trail_order=index['trail_order'], trail_rank=index['trail_rank'])
+
+
+# check the saved index is newer than every file of both source shapefiles (.shp, .dbf, ...)
+def species_index_is_current(path=SPECIES_INDEX_PATH):
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(datacache.source_mtime(name) < built for name in ('trails', 'grid'))
+
+
+# load the saved index, building and saving it first if it is missing or out of date
+def load_species_index(incidence, grid, codes, path=SPECIES_INDEX_PATH):
+    if species_index_is_current(path):
+        with np.load(path) as saved:
+            index = {key: saved[key] for key in saved.files}
+        index['codes'] = index['codes'].tolist()
+        if index['codes'] == list(codes) and index['cell_order'].shape[0] == len(grid) and index['trail_order'].shape[0] == np.count_nonzero(np.diff(incidence.indptr)):
+            return index
+
+    index = build_species_index(incidence, grid, codes)
+    save_species_index(index, path)
+    return index
+
+
+# the column of a species in the index. Raises KeyError if the species is not in it
+def species_column(index, code):
+    try:
+        return index['codes'].index(code)
+    except ValueError:
+        raise KeyError(f"The species '{code}' does not exist (in the data available)") from None
+
+
+# the number of top cells of a species to search: the top_grids best cells, limited to the
+# cells with an occupancy of at least threshold (either can be None for no limit)
+def cell_count(index, code, top_grids=None, threshold=None):
+    values = index['cell_values'][:, species_column(index, code)]
+    count = len(values) if top_grids is None else min(top_grids, len(values))
+    if threshold is not None:
+        # the values are sorted highest first, so the cells above the threshold are a prefix
+        count = min(count, int(np.searchsorted(-values, -threshold, side='right')))
+    return count
+
+
+# the top cells of a species, highest occupancy first
+def best_cells(index, code, top_grids=None, threshold=None):
+    return index['cell_order'][:cell_count(index, code, top_grids, threshold), species_column(index, code)]
+
+
+# the trails crossing the top cells of a species, best first, limited to top_trails
+def top_trails(index, code, top_trails=15, top_grids=None, threshold=None):
+    column = species_column(index, code)
+    found = np.searchsorted(index['trail_rank'][:, column], cell_count(index, code, top_grids, threshold)) # cumulative trail hits
+    return index['trail_order'][:found, column][:top_trails]
+
+
+# the trails crossing the top cells of every species in codes (e.g. both kea and kaka), limited
+# to top_trails. Trails are ordered by their worst best-cell rank across the species, so a trail
+# high on every list comes before one high on only some of them
+def trails_with_all(index, codes, top_trails=15, top_grids=None, threshold=None):
+    worst = None
+    for code in codes:
+        column = species_column(index, code)
+        found = np.searchsorted(index['trail_rank'][:, column], cell_count(index, code, top_grids, threshold))
+        rank = dict(zip(index['trail_order'][:found, column].tolist(), index['trail_rank'][:found, column].tolist()))
+        worst = rank if worst is None else {trail: max(worst[trail], r) for trail, r in rank.items() if trail in worst}
+    ranked = sorted(worst.items(), key=lambda item: (item[1], item[0])) if worst else []
+    return np.array([trail for trail, _ in ranked[:top_trails]], dtype=np.int32)
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from incidence import load_incidence
+    from occupancy import ATTRIBUTES_PATH, species_codes
+
+    trails = datacache.load('trails', columns=['geometry'])
+    grid = datacache.load('grid')
+    codes = species_codes(grid, pd.read_csv(ATTRIBUTES_PATH))
+
+    index = build_species_index(load_incidence(trails, grid), grid, codes)
+    save_species_index(index)
+
+    print(f"Species index saved: {len(codes)} species, {index['cell_order'].shape[0]} grid cells, {index['trail_order'].shape[0]} trails crossing the grid")
+    print(f'.../{SPECIES_INDEX_PATH}')
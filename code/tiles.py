@@ -0,0 +1,205 @@
+"""BirdTrails/tiles.py exports the DOC trails as a tiled web map for find_trail.py
+
+The default find_trail.py map puts every trail, at full detail, into one inline GeoJSON layer
+in Trail_maps.html, so the file grows with the trail dataset and is slow to open on a phone.
+This script exports the trails instead as:
+
+    Trail_tiles/<z>/<x>/<y>.js         the trails in one web map tile at one zoom level
+    Trail_tiles/trail_attributes.js    the tooltip details (name, difficulty, ...) of every trail
+    Trail_tiles.html                   a small Leaflet map that loads only the tiles in view
+
+At each zoom level the trails are simplified with the Douglas-Peucker algorithm to about one
+screen pixel, then cut to the standard web map tile grid, so a tile never holds more detail
+than can be seen. Tiles only carry a trail id, and the tooltip details are loaded once from
+the attribute index. The tiles are small scripts rather than .json files so the map also
+works when opened straight from the folder, without a web server.
+
+"""
+
+import os
+import json
+import html
+import math
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+
+# web mercator tile grid (EPSG:3857): half the width of the world (m) and the tile size (pixels)
+WORLD = 20037508.342789244
+TILE_SIZE = 256
+
+# zoom levels exported by default. The map starts at zoom 5, and above the highest level the
+# tiles of that level are reused
+MIN_ZOOM = 5
+MAX_ZOOM = 12
+
+# web mercator to longitude/latitude for the GeoJSON written in the tiles
+to_lonlat = Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+# the size of one screen pixel (m) at a zoom level, used as the simplification tolerance
+def pixel_size(zoom):
+    return 2 * WORLD / (TILE_SIZE * 2 ** zoom)
+
+
+# decimal places of longitude/latitude needed to place a vertex within a pixel at a zoom level
+def precision(zoom):
+    return math.ceil(-math.log10(360 / (TILE_SIZE * 2 ** zoom))) + 1
+
+
+# the x and y numbers of the tiles covering a web mercator bounding box at a zoom level
+def tile_range(bounds, zoom):
+    size = 2 * WORLD / 2 ** zoom
+    xmin, ymin, xmax, ymax = bounds
+    xs = range(int((xmin + WORLD) // size), int((xmax + WORLD) // size) + 1)
+    ys = range(int((WORLD - ymax) // size), int((WORLD - ymin) // size) + 1)
+    return xs, ys
+
+
+# a tile as a web mercator box
+def tile_box(zoom, x, y):
+    size = 2 * WORLD / 2 ** zoom
+    xmin, ymax = -WORLD + x * size, WORLD - y * size
+    return shapely.box(xmin, ymax - size, xmin + size, ymax)
+
+
+# keep only the line parts of a clipped trail (clipping at a tile edge can leave stray points)
+def line_parts(geom):
+    if shapely.get_type_id(geom) in (1, 5): # LineString, MultiLineString
+        return geom
+    parts = [part for part in shapely.get_parts(geom) if shapely.get_type_id(part) in (1, 5)]
+    return shapely.multilinestrings(parts) if parts else None
+
+
+# cut simplified trails into the tiles of one zoom level.
+# returns {(x, y): [(trail id, geometry in longitude/latitude), ...]}
+def cut_tiles(geoms, ids, zoom):
+    simplified = shapely.simplify(geoms, pixel_size(zoom), preserve_topology=False)
+
+    xs, ys = tile_range(shapely.total_bounds(simplified), zoom)
+    keys = [(x, y) for x in xs for y in ys]
+    boxes = np.array([tile_box(zoom, x, y) for x, y in keys])
+
+    # find the trails in each tile with one bulk query, then clip them all in one call
+    tile_idx, geom_idx = shapely.STRtree(simplified).query(boxes, predicate='intersects')
+    clipped = shapely.intersection(simplified[geom_idx], boxes[tile_idx])
+    digits = precision(zoom)
+    clipped = shapely.transform(clipped, lambda c: np.round(np.column_stack(to_lonlat.transform(c[:, 0], c[:, 1])), digits))
+
+    tiles = {}
+    for t, i, geom in zip(tile_idx, geom_idx, clipped):
+        geom = line_parts(geom)
+        if geom is not None and not geom.is_empty:
+            tiles.setdefault(keys[t], []).append((int(ids[i]), geom))
+    return tiles
+
+
+# write one tile as a script that hands its GeoJSON to the map
+def write_tile(path, zoom, x, y, features):
+    features = ','.join(f'{{"type":"Feature","properties":{{"id":{i}}},"geometry":{shapely.to_geojson(geom)}}}' for i, geom in features)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'birdtrailsTile({zoom},{x},{y},{{"type":"FeatureCollection","features":[{features}]}});\n')
+
+
+# write the tooltip details of every trail, by trail id
+def write_attributes(path, trails):
+    rows = []
+    for _, row in trails.iterrows():
+        rows.append([html.escape(str(row[field])) if row[field] == row[field] else '' for field in ('name', 'difficulty', 'completion', 'length')])
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'birdtrailsAttributes({json.dumps(rows, ensure_ascii=False)});\n')
+
+
+# the Leaflet map page. Tiles are requested by a grid layer limited to the area of the trails
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>BirdTrails - DOC trails</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{ width: 100%; height: 100%; margin: 0; }} .trail-tooltip th {{ text-align: left; padding-right: 6px; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var tileDir = {tile_dir};
+var map = L.map('map').setView([-40, 174], {min_zoom});
+L.tileLayer('https://tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
+  maxZoom: 19,
+  attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+}}).addTo(map);
+
+// tooltip details of every trail, by trail id, loaded once from the attribute index
+var attributes = [];
+function birdtrailsAttributes(rows) {{ attributes = rows; }}
+function tooltip(layer) {{
+  var a = attributes[layer.feature.properties.id] || ['', '', '', ''];
+  return '<table class="trail-tooltip"><tr><th>Trail name</th><td>' + a[0] + '</td></tr><tr><th>Difficulty</th><td>' + a[1] +
+    '</td></tr><tr><th>Completion time</th><td>' + a[2] + '</td></tr><tr><th>Trail length</th><td>' + a[3] + '</td></tr></table>';
+}}
+var attributeScript = document.createElement('script');
+attributeScript.src = tileDir + '/trail_attributes.js';
+document.head.appendChild(attributeScript);
+
+// trail tiles are loaded as scripts when they come into view and removed when they leave it
+var trails = L.layerGroup().addTo(map);
+var pending = {{}};
+function birdtrailsTile(z, x, y, data) {{
+  var tile = pending[z + '/' + x + '/' + y];
+  if (!tile) return;
+  delete pending[tile.key];
+  tile.layer = L.geoJSON(data, {{style: {{weight: 3, color: 'red'}}}}).bindTooltip(tooltip, {{sticky: false}}).addTo(trails);
+}}
+var TrailTiles = L.GridLayer.extend({{
+  createTile: function (coords) {{
+    var tile = document.createElement('div');
+    tile.key = coords.z + '/' + coords.x + '/' + coords.y;
+    pending[tile.key] = tile;
+    var script = document.createElement('script');
+    script.src = tileDir + '/' + tile.key + '.js';
+    script.onload = script.onerror = function () {{ script.remove(); }};
+    document.head.appendChild(script);
+    return tile;
+  }}
+}});
+var trailTiles = new TrailTiles({{minNativeZoom: {min_zoom}, maxNativeZoom: {max_zoom}, bounds: {bounds}}});
+trailTiles.on('tileunload', function (e) {{
+  delete pending[e.tile.key];
+  if (e.tile.layer) trails.removeLayer(e.tile.layer);
+}});
+trailTiles.addTo(map);
+</script>
+</body>
+</html>
+"""
+
+
+# export the trails as tiles, an attribute index and a map page.
+# trails needs 'name', 'difficulty', 'completion' and 'length' columns (as shown in the tooltip)
+def export_tiles(trails, html_path, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    tile_dir = os.path.splitext(html_path)[0]
+    os.makedirs(tile_dir, exist_ok=True)
+    write_attributes(os.path.join(tile_dir, 'trail_attributes.js'), trails)
+
+    # trail ids are their row positions, so tiles can refer to the attribute index
+    mercator = trails.to_crs(3857)
+    geoms = np.asarray(mercator['geometry'])
+    ids = np.arange(len(trails))
+
+    count = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        for (x, y), features in cut_tiles(geoms, ids, zoom).items():
+            write_tile(os.path.join(tile_dir, str(zoom), str(x), f'{y}.js'), zoom, x, y, features)
+            count += 1
+
+    # the area covered by the trails, so the map only asks for tiles there
+    west, south, east, north = trails.to_crs(4326).total_bounds
+    bounds = json.dumps([[south, west], [north, east]])
+
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(PAGE.format(tile_dir=json.dumps(os.path.basename(tile_dir)), min_zoom=min_zoom, max_zoom=max_zoom, bounds=bounds))
+    return count
@@ -0,0 +1,117 @@
+"""BirdTrails/trailsearch.py finds trails by name, including names typed slightly wrong
+
+Trail names have to be typed exactly in by_trail.py, macrons and curly apostrophes included
+('Big Tōtara Walk', 'Arthur’s Pass Walking Track'), and a typo means typing the name again.
+This script builds a search index of the trail names once and saves it in the data/cache folder
+(it is rebuilt when the trail data changes). The index holds:
+
+    names     each name in a normalised form (lower case, without macrons, apostrophes or
+              punctuation) -> the ids of every trail segment with that name, so a name is
+              found in one lookup however it is typed, and a name shared by several segments
+              finds all of them
+    trie      a prefix tree of the normalised names, to list the names starting with what
+              has been typed so far
+    ngrams    each three letter sequence -> the names containing it, to suggest the names
+              most alike a misspelt one ('Did you mean ...?')
+
+"""
+
+import os
+import json
+import unicodedata
+from collections import Counter
+import datacache
+
+
+# location of the saved index
+NAME_INDEX_PATH = os.path.join(datacache.CACHE_DIR, 'trail_names.json')
+
+# the key holding the names that end at a node of the trie
+END = '$'
+
+
+# a name in lower case, without macrons, apostrophes or punctuation and with single spaces,
+# e.g. 'Arthur’s Pass Walking Track' -> 'arthurs pass walking track'
+def normalise(name):
+    name = unicodedata.normalize('NFKD', str(name).casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c) and c not in '\'’‘`')
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in name).split())
+
+
+# the three letter sequences of a normalised name, padded so the start and end of words count
+def trigrams(name):
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# build the index from the trail names, in trail id order
+def build_name_index(trail_names):
+    names, display, trie, ngrams = {}, {}, {}, {}
+    for trail_id, name in enumerate(trail_names):
+        key = normalise(name)
+        if key not in names:
+            names[key], display[key] = [], str(name)
+            node = trie
+            for c in key:
+                node = node.setdefault(c, {})
+            node.setdefault(END, []).append(key)
+            for gram in trigrams(key):
+                ngrams.setdefault(gram, []).append(key)
+        names[key].append(trail_id)
+    return {'count': len(trail_names), 'names': names, 'display': display, 'trie': trie, 'ngrams': ngrams}
+
+
+# check the saved index is newer than the trail data
+def name_index_is_current(path=NAME_INDEX_PATH):
+    return os.path.exists(path) and os.path.getmtime(path) > datacache.source_mtime('trails')
+
+
+# load the saved index, building and saving it first if it is missing or out of date
+def load_name_index(trails, path=NAME_INDEX_PATH):
+    if name_index_is_current(path):
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index['count'] == len(trails):
+            return index
+
+    index = build_name_index(trails['name'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp{os.getpid()}', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(f'{path}.tmp{os.getpid()}', path)
+    return index
+
+
+# the trail name as written in the data, and the ids of every segment with that name, for a
+# name typed in any case, with or without macrons and punctuation. Raises KeyError if not found
+def find_trail(index, name):
+    key = normalise(name)
+    if key not in index['names']:
+        raise KeyError(f"The trail '{name}' does not exist in the geodatabase")
+    return index['display'][key], index['names'][key]
+
+
+# up to limit trail names starting with prefix, in alphabetical order
+def complete(index, prefix, limit=10):
+    node = index['trie']
+    for c in normalise(prefix):
+        if c not in node:
+            return []
+        node = node[c]
+
+    found, stack = [], [node]
+    while stack and len(found) < limit:
+        node = stack.pop()
+        found += node.get(END, [])
+        stack += [node[c] for c in sorted((c for c in node if c != END), reverse=True)]
+    return [index['display'][key] for key in found[:limit]]
+
+
+# up to limit trail names most alike name, the best first. Names are compared by the three
+# letter sequences they share (Dice coefficient), and only those scoring at least cutoff are given
+def suggest(index, name, limit=5, cutoff=0.4):
+    grams = trigrams(normalise(name))
+    shared = Counter(key for gram in grams for key in index['ngrams'].get(gram, []))
+    scores = [(2 * count / (len(grams) + len(trigrams(key))), key) for key, count in shared.items()]
+    best = sorted((-score, key) for score, key in scores if score >= cutoff)
+    return [index['display'][key] for _, key in best[:limit]]